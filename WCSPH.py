@@ -1,6 +1,7 @@
 #WSCPH.py
 import taichi as ti
 import sph_base
+import emitter
 import math
 
 class WCSPHSolver(sph_base.SPHBase):
@@ -8,19 +9,25 @@ class WCSPHSolver(sph_base.SPHBase):
         super().__init__(particle_system)
         self.gamma = self.ps.config['gamma']
         self.B = self.ps.config['B']
+        # Speed of sound of the equation of state in update_pressure, c^2 = dp/drho at rest density
+        self.sound_speed = math.sqrt(self.B * self.gamma / self.ps.density0)
         self.surface_tension = ti.field(ti.f32, shape=())
         self.surface_tension[None] = self.ps.config['surfaceTension']
 
         # Define crater parameters and an upward eruption force.
-        # Adjust these values as needed.
-        self.crater_position = ti.Vector([0.85, 0.15, 0.85])   # example crater position
-        self.crater_radius = 0.15                           # radius of crater influence
-        self.lava_force_magnitude = 20.0                    # upward force magnitude
+        # Adjust these values in the scene configuration.
+        self.crater_position = ti.Vector(self.ps.config.get('craterPosition', [0.85, 0.15, 0.85]))
+        self.crater_radius = self.ps.config.get('craterRadius', 0.15)  # radius of crater influence
+        self.lava_force_magnitude = self.ps.config.get('lavaForceMagnitude', 20.0)  # upward force magnitude
+        self.eruption_start_time = self.ps.config.get('eruptionStartTime', 0.6)
 
         self.time_step = ti.field(ti.i32, shape=())
         self.time_step[None] = 0
-        self.period = 2000  # number of steps for a full sine cycle
-        self.horizontal_force_magnitude = 5.0
+        self.period = self.ps.config.get('eruptionPeriod', 2000)  # number of steps for a full sine cycle
+        self.horizontal_force_magnitude = self.ps.config.get('horizontalForceMagnitude', 5.0)
+
+        self.emitter = emitter.Emitter(self) if self.ps.use_emitter else None
+        self.ps.emitter = self.emitter
 
 
     @ti.func
@@ -34,15 +41,25 @@ class WCSPHSolver(sph_base.SPHBase):
 
     @ti.kernel
     def update_density(self):
-        for i in range(self.ps.total_particle_num):
+        self.update_density_stage()
+
+    @ti.func
+    def update_density_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.material[i] == self.ps.material_fluid:
                 density = self.ps.mass[i] * self.cubic_spline_kernel(0.0)
                 self.ps.for_all_neighbors(i, self.update_density_task, density)
+                if ti.static(self.use_density_map):
+                    density += self.density_map.sample_density(self.ps.position[i])
                 self.ps.density[i] = density
 
     @ti.kernel
     def update_pressure(self):
-        for i in range(self.ps.total_particle_num):
+        self.update_pressure_stage()
+
+    @ti.func
+    def update_pressure_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.material[i] == self.ps.material_fluid:
                 self.ps.density[i] = ti.max(self.ps.density[i], self.ps.density0)
                 self.ps.pressure[i] = self.B * ((self.ps.density[i] / self.ps.density0) ** self.gamma - 1)
@@ -64,12 +81,19 @@ class WCSPHSolver(sph_base.SPHBase):
 
     @ti.kernel
     def compute_pressure_force(self):
-        for i in range(self.ps.total_particle_num):
+        self.compute_pressure_force_stage()
+
+    @ti.func
+    def compute_pressure_force_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.is_static_rigid_body(i):
                 self.ps.acceleration[i].fill(0.0)
             elif self.ps.material[i] == self.ps.material_fluid:
                 acc = ti.Vector.zero(ti.f32, self.ps.dim)
                 self.ps.for_all_neighbors(i, self.compute_pressure_force_task, acc)
+                if ti.static(self.use_density_map):
+                    p_rho_i = self.ps.pressure[i] / (self.ps.density[i] ** 2)
+                    acc -= p_rho_i * self.density_map.sample_gradient(self.ps.position[i])
                 self.ps.acceleration[i] += acc
 
     @ti.func
@@ -89,21 +113,46 @@ class WCSPHSolver(sph_base.SPHBase):
             pi = -nu * ti.min(v_ij.dot(x_ij), 0.0) / (x_ij.dot(x_ij) + 0.01 * self.ps.support_length ** 2)
             acc -= self.ps.mass[p_j] * pi * self.cubic_spline_kernel_derivative(x_ij)
         else:
-            sigma = self.ps.rigid_bodies_sigma[self.ps.object_id[p_j]]
+            sigma = self.ps.rigid_bodies_sigma[ti.cast(self.ps.object_id[p_j], ti.i32)]
             nu = sigma * self.ps.support_length * self.c_s / (2 * self.ps.density[p_i])
             v_ij = self.ps.velocity[p_i] - self.ps.velocity[p_j]
             x_ij = self.ps.position[p_i] - self.ps.position[p_j]
             pi = -nu * ti.min(v_ij.dot(x_ij), 0.0) / (x_ij.dot(x_ij) + 0.01 * self.ps.support_length ** 2)
             acc -= self.ps.density0 * self.ps.volume[p_j] * pi * self.cubic_spline_kernel_derivative(x_ij)
 
-    @ti.kernel
-    def compute_non_pressure_force(self):
-        simulation_time = self.time_step[None] * self.dt[None]
+    @ti.func
+    def eruption_forcing(self):
         time_factor = ti.sin(2 * math.pi * self.time_step[None] / self.period)
         upward_force = self.lava_force_magnitude * (0.5 + 0.5 * time_factor)
         horizontal_force_magnitude = self.horizontal_force_magnitude * (0.5 + 0.5 * time_factor)
+        return upward_force, horizontal_force_magnitude
+
+    @ti.func
+    def add_eruption_force(self, i, upward_force, horizontal_force_magnitude, acc: ti.template()):
+        # Apply eruption forces after a specific time
+        if self.simulation_time[None] > self.eruption_start_time:
+            p_pos = self.ps.position[i]
+            horizontal_dist = ((p_pos[0] - self.crater_position[0])**2 + (p_pos[2] - self.crater_position[2])**2)**0.5
 
-        for i in range(self.ps.total_particle_num):
+            if horizontal_dist < self.crater_radius:
+                # Direction vector for horizontal force
+                direction = ti.Vector([p_pos[0] - self.crater_position[0], 0.0, p_pos[2] - self.crater_position[2]])
+                if horizontal_dist > 0:  # Normalize to avoid division by zero
+                    direction = direction.normalized()
+
+                # Apply horizontal and upward forces
+                acc += horizontal_force_magnitude * direction
+                acc[1] += upward_force
+
+    @ti.kernel
+    def compute_non_pressure_force(self):
+        self.compute_non_pressure_force_stage()
+
+    @ti.func
+    def compute_non_pressure_force_stage(self):
+        upward_force, horizontal_force_magnitude = self.eruption_forcing()
+
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.is_static_rigid_body(i):
                 self.ps.acceleration[i].fill(0.0)
             else:
@@ -111,43 +160,131 @@ class WCSPHSolver(sph_base.SPHBase):
                 # Compute viscosity/surface tension for fluid
                 if self.ps.material[i] == self.ps.material_fluid:
                     self.ps.for_all_neighbors(i, self.compute_non_pressure_force_task, acc)
-
-                    # Apply eruption forces after a specific time
-                    if simulation_time > 0.6:
-                        p_pos = self.ps.position[i]
-                        horizontal_dist = ((p_pos[0] - self.crater_position[0])**2 + (p_pos[2] - self.crater_position[2])**2)**0.5
-
-                        if horizontal_dist < self.crater_radius:
-                            # Direction vector for horizontal force
-                            direction = ti.Vector([p_pos[0] - self.crater_position[0], 0.0, p_pos[2] - self.crater_position[2]])
-                            if horizontal_dist > 0:  # Normalize to avoid division by zero
-                                direction = direction.normalized()
-                            
-                            # Apply horizontal and upward forces
-                            acc += horizontal_force_magnitude * direction
-                            acc[1] += upward_force
+                    self.add_eruption_force(i, upward_force, horizontal_force_magnitude, acc)
 
                 self.ps.acceleration[i] = acc
 
 
+    @ti.func
+    def stable_time_step_bound(self):
+        """
+        The time step caps the GUI applies with a fixed time step. High viscosity and high surface tension go unstable
+        above them, which neither the CFL nor the force condition detects.
+        """
+        bound = self.dt_max
+        if self.viscosity[None] > 0.23 or self.surface_tension[None] > 2.0:
+            bound = 0.0005
+        if self.viscosity[None] > 0.23 and self.surface_tension[None] > 2.0:
+            bound = 0.0004
+        return bound
+
     @ti.kernel
     def advect(self):
-        for i in range(self.ps.total_particle_num):
+        self.advect_stage()
+
+    @ti.func
+    def advect_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.is_dynamic[i]:
                 self.ps.velocity[i] += self.ps.acceleration[i] * self.dt[None]
                 self.ps.position[i] += self.ps.velocity[i] * self.dt[None]
 
-    def substep(self):
-        self.update_density()
-        self.update_pressure()
-        self.compute_non_pressure_force()
-        self.compute_pressure_force()
-        self.advect()
+    @ti.kernel
+    def update_density_and_pressure(self):
+        self.update_density_and_pressure_stage()
+
+    @ti.func
+    def update_density_and_pressure_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.material[i] == self.ps.material_fluid:
+                density = self.ps.mass[i] * self.cubic_spline_kernel(0.0)
+                self.ps.for_all_neighbors(i, self.update_density_task, density)
+                if ti.static(self.use_density_map):
+                    density += self.density_map.sample_density(self.ps.position[i])
+                density = ti.max(density, self.ps.density0)
+                self.ps.density[i] = density
+                self.ps.pressure[i] = self.B * ((density / self.ps.density0) ** self.gamma - 1)
+
+    @ti.func
+    def compute_forces_task(self, p_i, p_j, acc: ti.template()):
+        self.compute_non_pressure_force_task(p_i, p_j, acc.non_pressure)
+        self.compute_pressure_force_task(p_i, p_j, acc.pressure)
+
+    @ti.kernel
+    def compute_forces(self):
+        self.compute_forces_stage()
+
+    @ti.func
+    def compute_forces_stage(self):
+        upward_force, horizontal_force_magnitude = self.eruption_forcing()
+
+        # Rigid particles only collect gravity here, plus the pressure reactions the fluid pass below adds to them.
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.is_static_rigid_body(i):
+                self.ps.acceleration[i].fill(0.0)
+            elif self.ps.material[i] != self.ps.material_fluid:
+                self.ps.acceleration[i] = ti.Vector(self.g)
+
+        # One neighbor traversal for both force terms. They are kept apart so the sum matches the unfused passes.
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.material[i] == self.ps.material_fluid:
+                acc = ti.Struct(non_pressure=ti.Vector(self.g), pressure=ti.Vector.zero(ti.f32, self.ps.dim))
+                self.ps.for_all_neighbors(i, self.compute_forces_task, acc)
+                self.add_eruption_force(i, upward_force, horizontal_force_magnitude, acc.non_pressure)
+                if ti.static(self.use_density_map):
+                    p_rho_i = self.ps.pressure[i] / (self.ps.density[i] ** 2)
+                    acc.pressure -= p_rho_i * self.density_map.sample_gradient(self.ps.position[i])
+                self.ps.acceleration[i] = acc.non_pressure + acc.pressure
+
+        if ti.static(self.adaptive_time_step):
+            self.update_time_step()
+
+    @ti.kernel
+    def advect_and_enforce_boundary(self):
+        self.advect_and_enforce_boundary_stage()
+
+    @ti.func
+    def advect_and_enforce_boundary_stage(self):
         self.time_step[None] += 1
-        self.increase_lifetime()
-    
+        self.simulation_time[None] += self.dt[None]
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.is_dynamic[i]:
+                self.ps.velocity[i] += self.ps.acceleration[i] * self.dt[None]
+                self.ps.position[i] += self.ps.velocity[i] * self.dt[None]
+                self.enforce_boundary(i)
+            self.ps.lifetime[i] += self.dt[None]
+
+    def substep_pipeline(self):
+        if self.fused_substep:
+            pipeline = [(self.update_density_and_pressure, self.update_density_and_pressure_stage),
+                        (self.compute_forces, self.compute_forces_stage),
+                        (self.advect_and_enforce_boundary, self.advect_and_enforce_boundary_stage)]
+        else:
+            pipeline = [(self.update_density, self.update_density_stage),
+                        (self.update_pressure, self.update_pressure_stage),
+                        (self.compute_non_pressure_force, self.compute_non_pressure_force_stage),
+                        (self.compute_pressure_force, self.compute_pressure_force_stage)]
+            if self.adaptive_time_step:
+                pipeline.append((self.compute_time_step, self.update_time_step))
+            pipeline += [(self.advect, self.advect_stage), (self.increase_lifetime, self.increase_lifetime_stage)]
+        if self.ps.use_emitter:
+            pipeline.append((self.emitter.emit, self.emitter.emit_stage))
+        return pipeline
+
+    def initialize(self):
+        if self.ps.use_emitter:
+            self.emitter.reset()
+        super().initialize()
+
     @ti.kernel
     def increase_lifetime(self):
-        for i in range(self.ps.total_particle_num):
+        self.increase_lifetime_stage()
+
+    @ti.func
+    def increase_lifetime_stage(self):
+        # The simulation clock advances together with the particle ages
+        self.time_step[None] += 1
+        self.simulation_time[None] += self.dt[None]
+        for i in range(self.ps.active_particle_num[None]):
             self.ps.lifetime[i] += self.dt[None]
 
@@ -0,0 +1,232 @@
+#benchmark.py
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import taichi as ti
+import trimesh as tm
+import particle_system
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Time every stage of the SPH pipeline on synthetic scenes of increasing particle count.')
+    parser.add_argument('--sizes', default='0.1,0.15,0.2,0.3',
+                        help='edge lengths of the fluid cube, the rigid floor grows with it')
+    parser.add_argument('--particle-radius', type=float, default=0.01)
+    parser.add_argument('--steps', type=int, default=20, help='timed steps per scene')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps before, they include compilation')
+    parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu', 'cuda', 'vulkan'], help='Taichi backend')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads, all cores by default')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON',
+                        help='Configuration override for every scene, e.g. fusedSubstep=true')
+    parser.add_argument('--output', default='benchmark_results.json', help='results (JSON)')
+    parser.add_argument('--baseline', default=None, help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown against the baseline reported as regression, 0.1 = 10%%')
+    parser.add_argument('--noise-floor', type=float, default=0.05,
+                        help='slowdowns below this many ms are timer noise and never reported as regression')
+    return parser.parse_args()
+
+
+def write_box_mesh(path, extents, center):
+    mesh = tm.creation.box(extents=extents)
+    mesh.apply_translation(center)
+    mesh.export(path)
+
+
+def synthetic_scene(size, particle_radius, mesh_path, overrides):
+    """
+    A fluid cube of edge size dropped on a static rigid floor plate twice as wide, in a domain that leaves room for
+    the padding around both.
+    """
+    margin = 8 * particle_radius
+    domain = 2 * size + 2 * margin
+    floor_thickness = 6 * particle_radius
+    floor_center = [domain / 2, margin + floor_thickness / 2, domain / 2]
+    write_box_mesh(mesh_path, [2 * size, floor_thickness, 2 * size], floor_center)
+    fluid_start = [domain / 2 - size / 2, margin + floor_thickness + 2 * particle_radius, domain / 2 - size / 2]
+    configuration = {
+        'domainStart': [0.0, 0.0, 0.0],
+        'domainEnd': [domain, domain, domain],
+        'particleRadius': particle_radius,
+        'numberOfStepsPerRenderUpdate': 1,
+        'density0': 1000,
+        'simulationMethod': 0,
+        'gravitation': [0.0, -9.81, 0.0],
+        'B': 5000,
+        'gamma': 7,
+        'dt': 4e-4,
+        'collisionFactor': 0.5,
+        'viscosity': 0.1,
+        'surfaceTension': 0.1,
+        'c_s': 88.5,
+        'voxelCacheDirectory': '',
+    }
+    configuration.update(overrides)
+    return {
+        'Configuration': configuration,
+        'RigidBodies': [{
+            'objectId': 1,
+            'geometryFile': mesh_path,
+            'translation': [0.0, 0.0, 0.0],
+            'rotationAxis': [0, 1, 0],
+            'rotationAngle': 0,
+            'scale': [1, 1, 1],
+            'velocity': [0.0, 0.0, 0.0],
+            'density': 1000.0,
+            'color': [0.4, 0.2, 0.1],
+            'isDynamic': False,
+            'sigma': 0.0008,
+        }],
+        'FluidBlocks': [{
+            'objectId': 0,
+            'start': fluid_start,
+            'end': [fluid_start[0] + size, fluid_start[1] + size, fluid_start[2] + size],
+            'translation': [0.0, 0.0, 0.0],
+            'scale': [1, 1, 1],
+            'velocity': [0.0, 0.0, 0.0],
+            'density': 1000.0,
+            'color': [1.0, 0.5, 0.0],
+        }],
+    }
+
+
+def step_stages(ps, solver):
+    """
+    (name, launch) of one step with update_particle_system split into its stages. The grid is rebuilt every step as
+    it is without a neighbor list, with one the list is rebuilt every step too, which is its worst case.
+    """
+    sort_arrays = (ps.counting_sort_countArray, ps.counting_sort_accumulatedArray)
+    stages = []
+    if ps.use_particle_deletion:
+        stages.append(('delete_particles', ps.delete_particles))
+    stages += [
+        ('update_grid_id', lambda: ps.update_grid_id(0, ps.active_particle_num, *sort_arrays)),
+        ('prefix_sum', lambda: ps.prefix_sum_executor.run(ps.counting_sort_accumulatedArray)),
+        ('counting_sort', lambda: ps.counting_sort(0, ps.active_particle_num, *sort_arrays)),
+        ('reorder_particle_attributes', lambda: ps.reorder_particle_attributes(0, ps.active_particle_num)),
+    ]
+    if ps.use_neighbor_list:
+        stages.append(('build_neighbor_list', ps.build_neighbor_list))
+    for launch in solver.substep_launches():
+        stages.append((launch.__name__, launch))
+    if not solver.fused_substep:
+        stages.append(('enforce_boundary_3D', solver.enforce_boundary_3D))
+    return stages
+
+
+def timed(launch):
+    ti.sync()
+    start = time.perf_counter()
+    launch()
+    ti.sync()
+    return time.perf_counter() - start
+
+
+def benchmark_scene(simulation_config, steps, warmup):
+    ps = particle_system.ParticleSystem(simulation_config)
+    ps.memory_allocation_and_initialization_only_position()
+    ps.memory_allocation_and_initialization()
+    solver = ps.build_solver()
+    solver.initialize()
+    # Once more after the compilation in initialize
+    boundary_volume_time = timed(solver.compute_volume_of_boundary_particle)
+
+    stages = step_stages(ps, solver)
+    samples = {name: [] for name, _ in stages}
+    for step in range(warmup + steps):
+        for name, launch in stages:
+            elapsed = timed(launch)
+            if step >= warmup:
+                samples[name].append(elapsed)
+
+    stage_ms = {name: 1000.0 * float(np.median(times)) for name, times in samples.items()}
+    stage_ms['compute_volume_of_boundary_particle'] = 1000.0 * boundary_volume_time
+    step_ms = sum(1000.0 * float(np.median(times)) for times in samples.values())
+    particle_num = ps.active_particle_num[None] + ps.total_static_rigid_particle_num
+    return {
+        'fluid_num': int(ps.total_fluid_particle_num),
+        'rigid_num': int(ps.total_rigid_particle_num),
+        'stage_ms': stage_ms,
+        'step_ms': step_ms,
+        'particle_steps_per_second': particle_num / (step_ms / 1000.0),
+    }
+
+
+def compare(results, baseline, tolerance, noise_floor):
+    """
+    Print the time of every stage relative to the baseline run of the same size. Returns the number of stages that
+    got slower by more than tolerance and by more than noise_floor ms.
+    """
+    baseline_runs = {run['size']: run for run in baseline['runs']}
+    regression_num = 0
+    for run in results['runs']:
+        reference = baseline_runs.get(run['size'])
+        if reference is None:
+            print('size {}: not in the baseline'.format(run['size']))
+            continue
+        print('size {} ({} fluid, {} rigid particles):'.format(run['size'], run['fluid_num'], run['rigid_num']))
+        for name, ms in list(run['stage_ms'].items()) + [('step', run['step_ms'])]:
+            reference_ms = reference['step_ms'] if name == 'step' else reference['stage_ms'].get(name)
+            if reference_ms is None or reference_ms <= 0.0:
+                continue
+            ratio = ms / reference_ms
+            regression = ratio > 1.0 + tolerance and ms - reference_ms > noise_floor
+            regression_num += regression
+            print('  {:<40s} {:9.3f} ms  x{:.2f}{}'.format(name, ms, ratio, '  REGRESSION' if regression else ''))
+    return regression_num
+
+
+def main():
+    args = parse_args()
+    arch = {'cpu': ti.cpu, 'gpu': ti.gpu, 'cuda': ti.cuda, 'vulkan': ti.vulkan}[args.arch]
+    if args.threads is not None:
+        ti.init(arch=arch, cpu_max_num_threads=args.threads, log_level=ti.WARN)
+    else:
+        ti.init(arch=arch, log_level=ti.WARN)
+    overrides = dict((key, json.loads(value)) for key, value in (item.split('=', 1) for item in args.set))
+
+    results = {
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': sys.version.split()[0],
+            'taichi': '.'.join(str(v) for v in ti.__version__),
+        },
+        'arch': args.arch,
+        'threads': args.threads,
+        'particle_radius': args.particle_radius,
+        'overrides': overrides,
+        'runs': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (float(size) for size in args.sizes.split(',')):
+            mesh_path = os.path.join(directory, 'floor_{}.obj'.format(size))
+            simulation_config = synthetic_scene(size, args.particle_radius, mesh_path, overrides)
+            run = benchmark_scene(simulation_config, args.steps, args.warmup)
+            run['size'] = size
+            results['runs'].append(run)
+            print('size {}: {} fluid + {} rigid particles, {:.2f} ms per step, {:.3e} particle steps/s'.format(
+                size, run['fluid_num'], run['rigid_num'], run['step_ms'], run['particle_steps_per_second']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regression_num = compare(results, baseline, args.tolerance, args.noise_floor)
+        if regression_num > 0:
+            print('{} stages slower than the baseline by more than {:.0%}'.format(regression_num, args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
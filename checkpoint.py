@@ -0,0 +1,153 @@
+#checkpoint.py
+import json
+import os
+import numpy as np
+import taichi as ti
+import particle_system
+
+MAGIC = b'SPHCKPT1'
+ALIGNMENT = 64
+# Per-frame scratch for rendering and export, rebuilt from the particle fields whenever it is used
+SCRATCH_FIELDS = {'fluid_only_color', 'fluid_only_position', 'tmp_cnt'}
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def state_owners(ps, solver):
+    owners = {'ps': ps, 'solver': solver}
+    if solver.ps.use_emitter:
+        owners['emitter'] = solver.emitter
+    if solver.use_density_map:
+        owners['density_map'] = solver.density_map
+    return owners
+
+
+def state_fields(ps, solver):
+    """
+    Every Taichi field held by the particle system, the solver, the emitter and the density map: particle attributes,
+    grid and neighbor list arrays, counters, time_step, dt, simulation_time and the parameters set from the GUI.
+    """
+    fields = dict()
+    for owner_name, owner in state_owners(ps, solver).items():
+        for name, value in vars(owner).items():
+            if isinstance(value, (ti.ScalarField, ti.MatrixField)) and name not in SCRATCH_FIELDS:
+                fields['{}.{}'.format(owner_name, name)] = value
+    return fields
+
+
+def scene_config(simulation_config):
+    # The scene as loaded from JSON, without what load_rigid_body attached to the rigid bodies
+    def strip(node):
+        if isinstance(node, dict):
+            return {key: strip(value) for key, value in node.items() if key not in ['voxelizedPoints', 'mesh']}
+        if isinstance(node, list):
+            return [strip(value) for value in node]
+        if isinstance(node, np.ndarray) or isinstance(node, np.generic):
+            return node.tolist()
+        return node
+    return strip(simulation_config)
+
+
+def save_checkpoint(path, ps, solver, frame=0):
+    """
+    Write the complete simulation state to a single file, replacing it atomically.
+
+    Layout: MAGIC, the length of the JSON header as uint64, the header, then every array at a 64 byte aligned offset
+    from the end of the header, so load_checkpoint can map them without reading the file. The header holds the scene
+    config, host side state and dtype, shape and offset of every array. The voxelized rigid bodies and their meshes
+    are stored too, so restarting never voxelizes.
+    """
+    arrays = {name: field.to_numpy() for name, field in state_fields(ps, solver).items()}
+    for rigid_body in ps.rigidBodiesConfig:
+        prefix = 'rigid_body.{}.'.format(rigid_body['objectId'])
+        arrays[prefix + 'points'] = np.asarray(rigid_body['voxelizedPoints'])
+        arrays[prefix + 'vertices'] = np.asarray(rigid_body['mesh'].vertices)
+        arrays[prefix + 'faces'] = np.asarray(rigid_body['mesh'].faces)
+
+    layout = dict()
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = align(offset + array.nbytes)
+    header = {
+        'config': scene_config(ps.simulation_config),
+        'frame': frame,
+        'host': {
+            'deletion_step': ps.deletion_step,
+            'neighbor_list_dirty': ps.neighbor_list_dirty,
+            'density_map_is_built': solver.density_map.is_built if solver.use_density_map else False,
+        },
+        'arrays': layout,
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = align(len(MAGIC) + 8 + len(header_bytes))
+
+    scratch_path = path + '.tmp'
+    with open(scratch_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(scratch_path, path)
+
+
+def read_checkpoint(path):
+    """
+    Header and memory-mapped arrays of a checkpoint.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a checkpoint'.format(path))
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = align(len(MAGIC) + 8 + header_length)
+    arrays = dict()
+    for name, entry in header['arrays'].items():
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=entry['dtype'])
+            continue
+        arrays[name] = np.memmap(path, dtype=entry['dtype'], mode='r', offset=data_start + entry['offset'],
+                                 shape=shape)
+    return header, arrays
+
+
+def load_checkpoint(path):
+    """
+    Rebuild the particle system and the solver from a checkpoint and continue exactly where save_checkpoint left off.
+    Returns (ps, solver, frame). Do not call solver.initialize() afterwards, it would rebuild state that is restored.
+    """
+    header, arrays = read_checkpoint(path)
+    ps = particle_system.ParticleSystem(header['config'])
+    for rigid_body in ps.rigidBodiesConfig:
+        prefix = 'rigid_body.{}.'.format(rigid_body['objectId'])
+        ps.preloaded_rigid_bodies[rigid_body['objectId']] = {
+            name: arrays[prefix + name] for name in ['points', 'vertices', 'faces']}
+    ps.memory_allocation_and_initialization_only_position()
+    ps.memory_allocation_and_initialization()
+    solver = ps.build_solver()
+
+    fields = state_fields(ps, solver)
+    missing = set(fields) - set(name for name in arrays if not name.startswith('rigid_body.'))
+    if missing:
+        raise ValueError('Checkpoint {} has no data for {}'.format(path, sorted(missing)))
+    for name, field in fields.items():
+        array = arrays[name]
+        if tuple(field.shape) != array.shape[:len(field.shape)]:
+            raise ValueError('Shape of {} is {} in the checkpoint but {} in the scene'.format(
+                name, array.shape, field.shape))
+        field.from_numpy(array)
+
+    host = header['host']
+    ps.deletion_step = host['deletion_step']
+    ps.neighbor_list_dirty = host['neighbor_list_dirty']
+    if solver.use_density_map:
+        # The map fields are restored, building it again would only repeat the same computation
+        solver.density_map.is_built = host['density_map_is_built']
+        if solver.density_map.is_built:
+            del solver.density_map.occupancy
+    return ps, solver, header['frame']
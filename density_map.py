@@ -0,0 +1,118 @@
+#density_map.py
+import taichi as ti
+import numpy as np
+
+
+@ti.data_oriented
+class DensityMap:
+    """
+    Density Maps for Improved SPH Boundary Handling, Koschier and Bender 2017
+
+    Boundary representation for static rigid bodies. Instead of keeping the voxelized body as particles, the
+    contribution those particles would make to a fluid particle at x is sampled once on a regular grid,
+
+        D(x) = sum_b psi_b W(x - x_b),    G(x) = grad D(x) = sum_b psi_b gradW(x - x_b),    psi_b = density0 * V_b
+
+    with the same boundary volume V_b as SPHBase.compute_volume_of_boundary_particle. The density and pressure
+    passes then read D and G with trilinear interpolation instead of looping over boundary neighbors.
+    Boundary viscosity (sigma) is not represented by the map.
+
+    At the grid nodes D equals the particle sum up to float rounding. In between, the interpolation error grows where
+    D is steep, right at the wall. Fluid resting on a floor sinks deeper into it by about 0.4 particle radii at
+    densityMapRefinement 1 and 0.04 at 4, see tests/test_density_map.py.
+    """
+    def __init__(self, solver, rigid_bodies):
+        self.solver = solver
+        self.ps = solver.ps
+        self.rigid_bodies = rigid_bodies
+        self.pitch = self.ps.particle_diameter
+        self.refinement = max(int(self.ps.config.get('densityMapRefinement', 1)), 1)
+        self.spacing = self.pitch / self.refinement
+        self.stencil_radius = int(np.ceil(self.ps.support_length / self.pitch))
+
+        # All voxelizations live on the lattice pitch * integer, so the bodies share one occupancy grid.
+        points = np.concatenate([rigid_body['voxelizedPoints'] for rigid_body in self.rigid_bodies], axis=0)
+        lattice_idx = np.round(points / self.pitch).astype(np.int64)
+        padding = self.stencil_radius + 1
+        lattice_start = lattice_idx.min(axis=0) - padding
+        self.occupancy_shape = tuple(int(n) for n in lattice_idx.max(axis=0) - lattice_start + padding + 1)
+        self.occupancy = np.zeros(self.occupancy_shape, dtype=np.int32)
+        self.occupancy[tuple((lattice_idx - lattice_start).T)] = 1
+
+        self.origin = lattice_start.astype(np.float32) * self.pitch
+        self.shape = tuple((n - 1) * self.refinement + 1 for n in self.occupancy_shape)
+        self.density = ti.field(dtype=ti.f32, shape=self.shape)
+        self.gradient = ti.Vector.field(self.ps.dim, dtype=ti.f32, shape=self.shape)
+        self.is_built = False
+
+    @ti.kernel
+    def compute_lattice_volume(self, occupancy: ti.types.ndarray(), volume: ti.types.ndarray()):
+        # Same as compute_volume_of_boundary_particle, evaluated on the occupancy lattice.
+        for I in ti.grouped(volume):
+            if occupancy[I]:
+                delta_bi = 0.0
+                for offset in ti.grouped(ti.ndrange(*(((-self.stencil_radius, self.stencil_radius + 1),) * 3))):
+                    J = I + offset
+                    if (J >= 0).all() and (J < ti.Vector(self.occupancy_shape)).all():
+                        if occupancy[J]:
+                            delta_bi += self.solver.cubic_spline_kernel(offset.cast(ti.f32).norm() * self.pitch)
+                volume[I] = 1.0 / delta_bi
+
+    @ti.kernel
+    def compute_map(self, occupancy: ti.types.ndarray(), volume: ti.types.ndarray()):
+        for I in ti.grouped(self.density):
+            lattice_idx = I // self.refinement
+            density = 0.0
+            gradient = ti.Vector.zero(ti.f32, self.ps.dim)
+            x = I.cast(ti.f32) * self.spacing
+            for offset in ti.grouped(ti.ndrange(*(((-self.stencil_radius, self.stencil_radius + 2),) * 3))):
+                J = lattice_idx + offset
+                if (J >= 0).all() and (J < ti.Vector(self.occupancy_shape)).all():
+                    if occupancy[J]:
+                        r = x - J.cast(ti.f32) * self.pitch
+                        if r.norm() < self.ps.support_length:
+                            psi = self.ps.density0 * volume[J]
+                            density += psi * self.solver.cubic_spline_kernel(r.norm())
+                            gradient += psi * self.solver.cubic_spline_kernel_derivative(r)
+            self.density[I] = density
+            self.gradient[I] = gradient
+
+    def build(self):
+        if self.is_built:
+            return
+        volume = np.zeros(self.occupancy_shape, dtype=np.float32)
+        self.compute_lattice_volume(self.occupancy, volume)
+        self.compute_map(self.occupancy, volume)
+        self.is_built = True
+        del self.occupancy
+
+    @ti.func
+    def trilinear_weights(self, position):
+        local = (position - ti.Vector(self.origin)) / self.spacing
+        base = ti.floor(local).cast(ti.i32)
+        inside = (base >= 0).all() and (base < ti.Vector(self.shape) - 1).all()
+        return base, local - base.cast(ti.f32), inside
+
+    @ti.func
+    def sample_density(self, position):
+        base, frac, inside = self.trilinear_weights(position)
+        density = 0.0
+        if inside:
+            for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+                weight = 1.0
+                for d in ti.static(range(3)):
+                    weight *= frac[d] if offset[d] == 1 else 1.0 - frac[d]
+                density += weight * self.density[base + offset]
+        return density
+
+    @ti.func
+    def sample_gradient(self, position):
+        base, frac, inside = self.trilinear_weights(position)
+        gradient = ti.Vector.zero(ti.f32, self.ps.dim)
+        if inside:
+            for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+                weight = 1.0
+                for d in ti.static(range(3)):
+                    weight *= frac[d] if offset[d] == 1 else 1.0 - frac[d]
+                gradient += weight * self.gradient[base + offset]
+        return gradient
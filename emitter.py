@@ -0,0 +1,174 @@
+#emitter.py
+import taichi as ti
+import numpy as np
+import particle_system
+
+
+@ti.data_oriented
+class Emitter:
+    """
+    Lava source at the crater of a WCSPHSolver.
+
+    ParticleSystem reserves 'capacity' slots in its dynamic range when it allocates memory, emit() spawns particles
+    into them from a kernel, so neither the fields nor the kernels change while the eruption runs. New particles are
+    appended after the active ones. Slots form a ring: once every slot is taken, the particles emitted longest ago are
+    respawned in place. The emitted count and the fractional rate accumulator live on the device.
+
+    Scene JSON, "Emitter": capacity, rate [particles/s], velocity, temperature, density, objectId and startTime [s],
+    which defaults to the eruptionStartTime of the solver.
+
+    New particles have no row in the neighbor list, so the list is rebuilt right after every non-empty batch. Once
+    the emitter spawns particles in most substeps, useNeighborList only adds the cost of the rebuild to the grid
+    search.
+    """
+    def __init__(self, solver):
+        self.solver = solver
+        self.ps = solver.ps
+        config = self.ps.emitter_config
+        self.capacity = self.ps.emitter_capacity
+        self.rate = config.get('rate', 1000.0)
+        self.velocity = ti.Vector(config.get('velocity', [0.0, 1.0, 0.0]))
+        self.temperature = config.get('temperature', 1200.0)
+        self.density = config.get('density', self.ps.density0)
+        self.object_id = config.get('objectId', self.ps.fluidBlocksConfig[0]['objectId'])
+        self.start_time = config.get('startTime', self.solver.eruption_start_time)
+
+        # One layer of particles on the crater disc at rest spacing. Consecutive particles fill the layer, a batch
+        # larger than the layer stacks further layers above it.
+        spacing = self.ps.particle_diameter
+        ring_num = int(np.floor(self.solver.crater_radius / spacing))
+        offsets = [(x * spacing, z * spacing) for x in range(-ring_num, ring_num + 1)
+                   for z in range(-ring_num, ring_num + 1) if x * x + z * z <= ring_num * ring_num]
+        self.layer_size = len(offsets)
+        self.layer_offset = ti.Vector.field(2, dtype=ti.f32, shape=self.layer_size)
+        self.layer_offset.from_numpy(np.array(offsets, dtype=np.float32))
+        # A layer position is reused after layer_size particles, by then its last particle has to be one diameter away
+        max_rate = self.layer_size * self.velocity.norm() / spacing
+        if self.rate > max_rate:
+            print('Warning: Emitter rate {} is above {:.0f}, emitted particles will overlap.'.format(
+                self.rate, max_rate))
+
+        # rate * dt particles per substep on average, above 0.5 most substeps expire the neighbor list
+        if self.ps.use_neighbor_list and self.rate * self.solver.dt[None] > 0.5:
+            print('Warning: Emitter rate {} spawns particles in most substeps, every one rebuilds the neighbor list. '
+                  'Grid search (useNeighborList false) is faster.'.format(self.rate))
+
+        self.emitted_num = ti.field(dtype=ti.i32, shape=())
+        self.rate_accumulator = ti.field(dtype=ti.f32, shape=())
+        self.batch_begin = ti.field(dtype=ti.i32, shape=())
+        self.batch_num = ti.field(dtype=ti.i32, shape=())
+        self.recycle_end = ti.field(dtype=ti.i32, shape=())
+        self.slot_recycled = ti.field(dtype=ti.i32, shape=self.capacity)
+        # Position and velocity of a particle placed by add_particle
+        self.particle_position = ti.Vector.field(self.ps.dim, dtype=ti.f32, shape=())
+        self.particle_velocity = ti.Vector.field(self.ps.dim, dtype=ti.f32, shape=())
+
+    def reset(self):
+        self.emitted_num[None] = 0
+        self.rate_accumulator[None] = 0.0
+        self.slot_recycled.fill(0)
+
+    @ti.func
+    def crater_position(self, emission_idx):
+        layer_idx = emission_idx - self.batch_begin[None]
+        offset = self.layer_offset[emission_idx % self.layer_size]
+        return self.solver.crater_position + ti.Vector(
+            [offset[0], (layer_idx // self.layer_size) * self.ps.particle_diameter, offset[1]])
+
+    @ti.func
+    def spawn(self, i, slot, position, velocity):
+        self.ps.position[i] = position
+        self.ps.velocity[i] = velocity
+        self.ps.acceleration[i] = ti.Vector.zero(ti.f32, self.ps.dim)
+        self.ps.material[i] = ti.cast(self.ps.material_fluid, self.ps.material.dtype)
+        self.ps.color[i] = ti.cast(particle_system.temperature_to_color(self.temperature), self.ps.color.dtype)
+        self.ps.object_id[i] = ti.cast(self.object_id, self.ps.object_id.dtype)
+        self.ps.volume[i] = self.ps.particle_volume
+        self.ps.density[i] = self.density
+        self.ps.mass[i] = self.ps.particle_volume * self.density
+        self.ps.pressure[i] = 0.0
+        self.ps.is_dynamic[i] = ti.cast(1, self.ps.is_dynamic.dtype)
+        self.ps.lifetime[i] = 0.0
+        self.ps.temperature[i] = ti.cast(self.temperature, self.ps.temperature.dtype)
+        self.ps.emitter_slot[i] = slot
+
+    @ti.func
+    def reserve_batch(self, batch_num):
+        self.batch_begin[None] = self.emitted_num[None]
+        self.batch_num[None] = batch_num
+        self.emitted_num[None] += batch_num
+        # Before the ring wraps around, no particle can hold a slot of the batch
+        self.recycle_end[None] = 0
+        if self.emitted_num[None] > self.capacity:
+            self.recycle_end[None] = self.ps.active_particle_num[None]
+        if ti.static(self.ps.use_neighbor_list):
+            if batch_num > 0:
+                self.ps.neighbor_list_expired[None] = 1
+
+    @ti.kernel
+    def emit_batch(self, from_crater: ti.template()):
+        self.emit_batch_stage(from_crater)
+
+    @ti.func
+    def emit_batch_stage(self, from_crater: ti.template()):
+        # Respawn live particles whose slot comes up again, then append the rest after the active particles.
+        for i in range(self.recycle_end[None]):
+            slot = self.ps.emitter_slot[i]
+            if slot >= 0:
+                k = (slot - self.batch_begin[None] % self.capacity + self.capacity) % self.capacity
+                if k < self.batch_num[None]:
+                    emission_idx = self.batch_begin[None] + k
+                    if ti.static(from_crater):
+                        self.spawn(i, slot, self.crater_position(emission_idx), self.velocity)
+                    else:
+                        self.spawn(i, slot, self.particle_position[None], self.particle_velocity[None])
+                    self.slot_recycled[slot] = 1
+        for k in range(self.batch_num[None]):
+            emission_idx = self.batch_begin[None] + k
+            slot = emission_idx % self.capacity
+            if self.slot_recycled[slot]:
+                self.slot_recycled[slot] = 0
+            else:
+                i = ti.atomic_add(self.ps.active_particle_num[None], 1)
+                if ti.static(from_crater):
+                    self.spawn(i, slot, self.crater_position(emission_idx), self.velocity)
+                else:
+                    self.spawn(i, slot, self.particle_position[None], self.particle_velocity[None])
+
+    @ti.kernel
+    def reserve_crater_batch(self):
+        self.reserve_crater_batch_stage()
+
+    @ti.func
+    def reserve_crater_batch_stage(self):
+        batch_num = 0
+        if self.solver.simulation_time[None] >= self.start_time:
+            self.rate_accumulator[None] += self.rate * self.solver.dt[None]
+            batch_num = ti.min(ti.cast(self.rate_accumulator[None], ti.i32), self.capacity)
+            self.rate_accumulator[None] -= batch_num
+        self.reserve_batch(batch_num)
+
+    @ti.kernel
+    def reserve_single_particle(self):
+        self.reserve_batch(1)
+
+    def emit(self):
+        """
+        Spawn the particles due in this substep at the crater, rate * dt on average.
+        """
+        self.reserve_crater_batch()
+        self.emit_batch(True)
+        self.ps.rebuild_expired_neighbor_list()
+
+    @ti.func
+    def emit_stage(self):
+        # emit for SPHBase.run_steps, which never has a neighbor list to rebuild
+        self.reserve_crater_batch_stage()
+        self.emit_batch_stage(True)
+
+    def add_particle(self, position, velocity):
+        self.particle_position[None] = position
+        self.particle_velocity[None] = velocity
+        self.reserve_single_particle()
+        self.emit_batch(False)
+        self.ps.rebuild_expired_neighbor_list()
@@ -0,0 +1,130 @@
+#exporter.py
+import gzip
+import os
+import queue
+import threading
+import numpy as np
+import taichi as ti
+
+
+@ti.data_oriented
+class FrameExporter:
+    """
+    Writes the fluid particles of a frame to output_dir in a background thread.
+
+    export() copies the fluid positions and temperatures from the device straight into one of two host buffers and
+    hands it to the writer thread, so the simulation only waits when the writer is still busy with both buffers.
+    The rigid body meshes do not change during a run and are written once, as obj_<objectId>.obj.
+
+    Formats, given as arguments or by the Configuration keys exportFormat, exportCompress and exportQuantize:
+        'ply': binary little endian PLY with float x, y, z, temperature; gzipped as .ply.gz with compress
+        'npz': NumPy archive with 'position' and 'temperature'; savez_compressed with compress
+    With quantize, positions are stored as uint16 over the domain box (error below domain size / 65535) and the
+    archive holds 'origin' and 'scale' to restore them as origin + position * scale. Only for 'npz'.
+    """
+    FORMATS = ['ply', 'npz']
+
+    def __init__(self, ps, output_dir, export_format=None, compress=None, quantize=None):
+        self.ps = ps
+        self.output_dir = output_dir
+        self.format = export_format or ps.config.get('exportFormat', 'ply')
+        self.compress = ps.config.get('exportCompress', False) if compress is None else compress
+        self.quantize = ps.config.get('exportQuantize', False) if quantize is None else quantize
+        if self.format not in self.FORMATS:
+            raise ValueError('Unknown export format {}, expected one of {}'.format(self.format, self.FORMATS))
+        if self.quantize and self.format != 'npz':
+            raise ValueError('Quantized export needs the npz format')
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        self.origin = np.array(self.ps.domain_start, dtype=np.float32)
+        self.scale = (np.array(self.ps.domain_end, dtype=np.float32) - self.origin) / 65535.0
+        capacity = self.ps.fluid_particle_capacity
+        position_dtype = np.uint16 if self.quantize else np.float32
+        self.buffers = [(np.zeros((capacity, self.ps.dim), dtype=position_dtype), np.zeros(capacity, dtype=np.float32))
+                        for _ in range(2)]
+        self.free_buffers = queue.Queue()
+        for buffer_idx in range(len(self.buffers)):
+            self.free_buffers.put(buffer_idx)
+        self.frames = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.write_frames, daemon=True)
+        self.writer.start()
+        self.meshes_written = False
+
+    @ti.kernel
+    def snapshot(self, position: ti.types.ndarray(), temperature: ti.types.ndarray()) -> ti.i32:
+        count = 0
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.material[i] == self.ps.material_fluid:
+                k = ti.atomic_add(count, 1)
+                for d in ti.static(range(self.ps.dim)):
+                    if ti.static(self.quantize):
+                        q = (self.ps.position[i][d] - ti.Vector(self.origin)[d]) / ti.Vector(self.scale)[d] + 0.5
+                        position[k, d] = ti.cast(ti.math.clamp(q, 0.0, 65535.0), ti.u16)
+                    else:
+                        position[k, d] = self.ps.position[i][d]
+                temperature[k] = ti.cast(self.ps.temperature[i], ti.f32)
+        return count
+
+    def write_meshes(self):
+        for r_body_id in self.ps.rigid_object_id:
+            with open(os.path.join(self.output_dir, 'obj_{}.obj'.format(r_body_id)), 'w') as f:
+                f.write(self.ps.object_collection[r_body_id]['mesh'].export(file_type='obj'))
+        self.meshes_written = True
+
+    def export(self, frame_idx):
+        if self.error is not None:
+            raise self.error
+        if not self.meshes_written:
+            self.write_meshes()
+        # Blocks only while the writer still holds both buffers
+        buffer_idx = self.free_buffers.get()
+        position, temperature = self.buffers[buffer_idx]
+        particle_num = self.snapshot(position, temperature)
+        self.frames.put((frame_idx, buffer_idx, particle_num))
+
+    def close(self):
+        self.frames.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def write_frames(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            frame_idx, buffer_idx, particle_num = item
+            position, temperature = self.buffers[buffer_idx]
+            try:
+                if self.error is None:
+                    if self.format == 'ply':
+                        self.write_ply(frame_idx, position[:particle_num], temperature[:particle_num])
+                    else:
+                        self.write_npz(frame_idx, position[:particle_num], temperature[:particle_num])
+            except Exception as e:
+                self.error = e
+            self.free_buffers.put(buffer_idx)
+
+    def frame_path(self, frame_idx, extension):
+        return os.path.join(self.output_dir, 'particle_object_0_{:06}.{}'.format(frame_idx, extension))
+
+    def write_ply(self, frame_idx, position, temperature):
+        vertex = np.empty(position.shape[0], dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('temperature', '<f4')])
+        vertex['x'], vertex['y'], vertex['z'] = position[:, 0], position[:, 1], position[:, 2]
+        vertex['temperature'] = temperature
+        header = ('ply\nformat binary_little_endian 1.0\nelement vertex {}\n'
+                  'property float x\nproperty float y\nproperty float z\nproperty float temperature\n'
+                  'end_header\n').format(position.shape[0])
+        path = self.frame_path(frame_idx, 'ply.gz' if self.compress else 'ply')
+        with (gzip.open(path, 'wb', compresslevel=1) if self.compress else open(path, 'wb')) as f:
+            f.write(header.encode('ascii'))
+            f.write(vertex.tobytes())
+
+    def write_npz(self, frame_idx, position, temperature):
+        arrays = {'position': position, 'temperature': temperature}
+        if self.quantize:
+            arrays['origin'] = self.origin
+            arrays['scale'] = self.scale
+        save = np.savez_compressed if self.compress else np.savez
+        save(self.frame_path(frame_idx, 'npz'), **arrays)
@@ -0,0 +1,33 @@
+#kernel_table_check.py
+"""
+Accuracy and speed of the tabulated cubic spline kernel (Configuration 'kernelTableSize') against the analytic one,
+for the support length of a scene.
+
+python kernel_table_check.py --scene ./data/scenes/volcano_eruption.json --sizes 64 256 1024 4096
+"""
+import argparse
+import json
+import taichi as ti
+import particle_system
+import WCSPH
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--scene', default='./data/scenes/volcano_eruption.json')
+parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256, 1024, 4096])
+parser.add_argument('--samples', type=int, default=1000000)
+parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu'])
+args = parser.parse_args()
+
+ti.init(arch=ti.cpu if args.arch == 'cpu' else ti.gpu)
+
+with open(args.scene, 'r') as f:
+    simulation_config = json.load(f)
+
+ps = particle_system.ParticleSystem(simulation_config)
+print('{:>10} {:>14} {:>14} {:>12} {:>12}'.format('size', 'W rel. err', 'dW rel. err', 'table [s]', 'analytic [s]'))
+for size in args.sizes:
+    ps.config['kernelTableSize'] = size
+    report = WCSPH.WCSPHSolver(ps).check_kernel_table(args.samples)
+    print('{:>10} {:>14.3e} {:>14.3e} {:>12.4f} {:>12.4f}'.format(
+        size, report['kernel_relative_error'], report['derivative_relative_error'],
+        report['table_time'], report['analytic_time']))
@@ -1,8 +1,12 @@
 #particle_system.py
 import taichi as ti
 import numpy as np
+import time
 import trimesh as tm
 import WCSPH
+import space_filling_curve
+import voxel_cache
+import voxelizer
 
 @ti.func
 def temperature_to_color(temp: ti.f32) -> ti.Vector:
@@ -25,6 +29,63 @@ def temperature_to_color(temp: ti.f32) -> ti.Vector:
     return color
 
 
+# Storage types of the attributes that do not feed the physics. Colors and temperatures only drive rendering and
+# cooling, and material, is_dynamic and object_id are small flags. Position, velocity, density etc. stay f32.
+COMPACT_STORAGE = {
+    'color': ti.f16,
+    'temperature': ti.f16,
+    'material': ti.u8,
+    'is_dynamic': ti.u8,
+    'object_id': ti.u16,
+}
+
+
+def dtype_size(dtype):
+    return np.dtype(ti.lang.util.to_numpy_type(dtype)).itemsize
+
+
+@ti.data_oriented
+class BlockedPrefixSumExecutor:
+    """
+    Inclusive prefix sum with the same interface as ti.algorithms.PrefixSumExecutor, which only runs on CUDA and
+    Vulkan. Blocks are scanned in parallel, then the block sums are scanned serially and added back.
+    """
+    def __init__(self, length, block_size=4096):
+        self.length = length
+        self.block_size = block_size
+        self.block_num = (length + block_size - 1) // block_size
+        self.block_sum = ti.field(dtype=ti.i32, shape=max(self.block_num, 1))
+
+    @ti.kernel
+    def scan(self, arr: ti.template(), length: int):
+        self.inclusive_scan(arr, length)
+
+    @ti.func
+    def inclusive_scan(self, arr: ti.template(), length):
+        for b in range(self.block_num):
+            block_start = b * self.block_size
+            block_end = ti.min(block_start + self.block_size, length)
+            acc = 0
+            for i in range(block_start, block_end):
+                acc += arr[i]
+                arr[i] = acc
+            self.block_sum[b] = acc
+        ti.loop_config(serialize=True)
+        for b in range(1, self.block_num):
+            self.block_sum[b] += self.block_sum[b - 1]
+        for i in range(self.block_size, length):
+            arr[i] += self.block_sum[i // self.block_size - 1]
+
+    def run(self, arr):
+        self.scan(arr, self.length)
+
+
+def make_prefix_sum_executor(length):
+    if ti.lang.impl.current_cfg().arch in [ti.cuda, ti.vulkan]:
+        return ti.algorithms.PrefixSumExecutor(length)
+    return BlockedPrefixSumExecutor(length)
+
+
 @ti.data_oriented
 class ParticleSystem:
     def __init__(self, simulation_config):
@@ -43,14 +104,84 @@ class ParticleSystem:
         # TODO: Check coefficient (0.8 * self.particle_diameter ** self.dim)
         self.particle_volume = (4 / 3) * np.pi * (self.particle_radius ** self.dim)
         self.support_length = 4 * self.particle_radius
-        self.grid_size = self.support_length
+
+        # Verlet-style neighbor list. Neighbors are gathered within support_length + skin and the list is reused
+        # until some particle has moved more than half of the skin, so grid sort and search are skipped meanwhile.
+        # Emitted and deleted particles expire the list, so it does not pay off with an emitter running every substep.
+        self.use_neighbor_list = self.config.get('useNeighborList', False)
+        self.neighbor_list_skin = self.config.get('neighborListSkinRatio', 0.2) * self.support_length \
+            if self.use_neighbor_list else 0.0
+        self.max_neighbor_num = self.config.get('maxNeighborNum', 128)
+        self.neighbor_search_radius = self.support_length + self.neighbor_list_skin
+
+        self.grid_size = self.neighbor_search_radius
         self.padding = self.support_length  # padding is used for boundary condition when particle collide with wall
         self.grid_num = np.ceil(self.domain_size / self.grid_size).astype(np.int32)
+        # 'dense' keeps one counting sort slot per grid cell of the domain. 'hashed' maps cells into a hash table
+        # whose size follows the particle count, so memory and prefix sum cost no longer grow with domain volume.
+        self.grid_mode = self.config.get('gridMode', 'dense')
+        if self.grid_mode not in ['dense', 'hashed']:
+            raise ValueError('Unknown gridMode: {}'.format(self.grid_mode))
+        self.use_hashed_grid = self.grid_mode == 'hashed'
+        # Order in which cells (and so the sorted particles) are laid out in memory. 'morton' and 'hilbert' keep the
+        # 27 cells of a neighbor stencil close together. In hashed mode 'morton' hashes the Z-order code itself.
+        self.cell_ordering = self.config.get('cellOrdering', 'linear')
+        if self.cell_ordering not in ['linear', 'morton', 'hilbert']:
+            raise ValueError('Unknown cellOrdering: {}'.format(self.cell_ordering))
+        if self.use_hashed_grid and self.cell_ordering == 'hilbert':
+            raise ValueError('cellOrdering hilbert is only available with gridMode dense')
+        self.use_cell_order_table = not self.use_hashed_grid and self.cell_ordering != 'linear'
         self.material_rigid = 0
         self.material_fluid = 1
         self.memory_allocated_particle_num = ti.field(dtype=ti.i32, shape=())
         self.memory_allocated_particle_num[None] = 0
+        # Particles in use are packed at the front of the dynamic range, the static rigid particles start at its end
+        self.active_particle_num = ti.field(dtype=ti.i32, shape=())
+        self.static_particle_end = ti.field(dtype=ti.i32, shape=())
         self.cur_obj_id = 0
+        # name -> (dtype, number of components) of every per-particle field. The registry drives allocation,
+        # reordering in counting_sort and free_memory_allocation, so a new attribute only has to be added once.
+        self.particle_attributes = dict()
+        self.sort_buffers = dict()
+        # 'full' stores every attribute at 32 bits, 'compact' overrides the types listed in COMPACT_STORAGE.
+        self.storage_profile = self.config.get('storageProfile', 'full')
+        if self.storage_profile not in ['full', 'compact']:
+            raise ValueError('Unknown storageProfile: {}'.format(self.storage_profile))
+        self.attribute_storage = COMPACT_STORAGE if self.storage_profile == 'compact' else dict()
+        self.density_map_bodies = []
+        # Lava source at the crater, see emitter.Emitter. Its capacity is reserved in the dynamic range up front so
+        # spawning never reallocates a field.
+        self.emitter_config = self.simulation_config.get('Emitter', None)
+        self.emitter_capacity = self.emitter_config['capacity'] if self.emitter_config is not None else 0
+        self.use_emitter = self.emitter_capacity > 0
+        self.emitter = None
+
+        # Fluid particles are deleted every deletionInterval steps once they reach a domain wall, live longer than
+        # maxLifetime or cool down to deletionTemperature. The survivors are compacted to the front of the dynamic
+        # range so every kernel only iterates over particles still in use. Off by default, the scene
+        # volcano_eruption_open_walls.json lets the lava leave through the walls.
+        self.delete_at_domain_boundary = self.config.get('deleteAtDomainBoundary', False)
+        # Walls that delete, as axis and side, e.g. 'x-' is the wall at the domain start along x. The floor (y-) is
+        # left out by default, lava settling on it is kept on the wall by enforce_boundary and never leaves the domain.
+        deletion_walls = self.config.get('deletionWalls', ['x-', 'x+', 'y+', 'z-', 'z+'])
+        self.deletion_wall_lower = tuple('xyz'[d] + '-' in deletion_walls for d in range(self.dim))
+        self.deletion_wall_upper = tuple('xyz'[d] + '+' in deletion_walls for d in range(self.dim))
+        self.max_lifetime = self.config.get('maxLifetime', 0.0)  # 0 keeps particles forever
+        self.deletion_temperature = self.config.get('deletionTemperature', None)
+        self.use_deletion_temperature = self.deletion_temperature is not None
+        self.use_particle_deletion = self.delete_at_domain_boundary or self.max_lifetime > 0 or \
+            self.use_deletion_temperature
+        self.deletion_interval = self.config.get('deletionInterval', 10)
+        self.deletion_step = 0
+
+        # Voxelized rigid bodies are cached on disk, an empty string or null disables the cache
+        voxel_cache_directory = self.config.get('voxelCacheDirectory', './data/voxel_cache')
+        self.voxel_cache = voxel_cache.VoxelCache(voxel_cache_directory) if voxel_cache_directory else None
+        # Workers used by rigid bodies with "voxelizer": "parallel", null uses every CPU. Threads after ti.init.
+        self.voxelizer_worker_num = self.config.get('voxelizerWorkers', None)
+        # objectId -> {'points', 'vertices', 'faces'} of rigid bodies restored from a checkpoint, see checkpoint.py.
+        # load_rigid_body takes them as they are, without reading the geometry file.
+        self.preloaded_rigid_bodies = dict()
 
     def memory_allocation_and_initialization_only_position(self):
         self.memory_allocated_particle_num[None] = 0
@@ -69,24 +200,41 @@ class ParticleSystem:
         self.mesh_vertices = []
         self.mesh_indices = []
 
+        self.total_static_rigid_particle_num = 0
+        self.density_map_bodies = []
         for rigid_body in self.rigidBodiesConfig:
             voxelized_points = self.load_rigid_body(rigid_body)
+            rigid_body['voxelizedPoints'] = voxelized_points
+            self.cur_obj_id = ti.max(self.cur_obj_id, rigid_body['objectId'])
+            if self.is_density_map_body(rigid_body):
+                # Represented by SPHBase.density_map instead of particles.
+                if rigid_body['isDynamic']:
+                    raise ValueError('boundaryModel densityMap is only available for static rigid bodies')
+                rigid_body['particleNum'] = 0
+                self.density_map_bodies.append(rigid_body)
+                continue
             rigid_particle_num = voxelized_points.shape[0]
             rigid_body['particleNum'] = rigid_particle_num
-            rigid_body['voxelizedPoints'] = voxelized_points
 
             self.total_rigid_particle_num += rigid_particle_num
-            self.cur_obj_id = ti.max(self.cur_obj_id, rigid_body['objectId'])
-
-        self.total_particle_num = self.total_rigid_particle_num + self.total_fluid_particle_num
-
-        self.position = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
-        self.color = ti.Vector.field(3, dtype=ti.f32, shape=self.total_particle_num)
-        self.material = ti.field(dtype=ti.i32, shape=self.total_particle_num)
-        self.lifetime = ti.field(ti.f32, shape=self.total_particle_num)
+            if not rigid_body['isDynamic']:
+                self.total_static_rigid_particle_num += rigid_particle_num
+
+        self.fluid_particle_capacity = self.total_fluid_particle_num + self.emitter_capacity
+        self.total_particle_num = self.total_rigid_particle_num + self.fluid_particle_capacity
+        # Memory layout: [fluid | dynamic rigid | emitter slots | static rigid]. Particles in use are packed at the
+        # front of the dynamic range, only [0, active_particle_num) is sorted and simulated every step. Static rigid
+        # particles start at dynamic_particle_num and are sorted once into their own grid by build_static_grid.
+        self.dynamic_particle_num = self.total_particle_num - self.total_static_rigid_particle_num
+        self.active_particle_num[None] = self.dynamic_particle_num - self.emitter_capacity
+        self.static_particle_end[None] = self.total_particle_num
+
+        self.add_particle_attribute('position', ti.f32, self.dim)
+        self.add_particle_attribute('color', ti.f32, 3)
+        self.add_particle_attribute('material', ti.i32)
+        self.add_particle_attribute('lifetime', ti.f32)
         #self.reset_lifetime()
-        self.temperature = ti.field(ti.f32, shape=self.total_particle_num)
-        self.initialize_temperature(1200.0)
+        self.add_particle_attribute('temperature', ti.f32)
 
         # ========== Initialize particles ==========#
 
@@ -101,7 +249,7 @@ class ParticleSystem:
             self.add_cube(box_start=start + offset, box_end=end + offset, color=color, material=self.material_fluid)
 
         # Rigid bodies
-        for rigid_body in self.rigidBodiesConfig:
+        for rigid_body in self.allocate_rigid_bodies():
             rigid_body_particle_num = rigid_body['particleNum']
             color = rigid_body['color']
             if type(color[0]) == int:
@@ -112,6 +260,8 @@ class ParticleSystem:
                 material=np.full((rigid_body_particle_num,), self.material_rigid, dtype=np.int32),
                 color=np.tile(np.array(color, dtype=np.float32), (rigid_body_particle_num, 1)))
 
+        self.initialize_temperature(1200.0)
+
     def memory_allocation_and_initialization(self):
         self.memory_allocated_particle_num[None] = 0
         self.object_collection = dict()
@@ -134,50 +284,81 @@ class ParticleSystem:
 
         # ========== Allocate memory ==========#
         # Grid Related
-        total_grid_num = 1
-        for i in range(self.dim):
-            total_grid_num *= self.grid_num[i]
+        if self.use_hashed_grid:
+            self.hash_table_size = self.compute_hash_table_size()
+            self.hash_table_mask = self.hash_table_size - 1
+            total_grid_num = self.hash_table_size
+        else:
+            total_grid_num = 1
+            for i in range(self.dim):
+                total_grid_num *= int(self.grid_num[i])
+        if self.use_cell_order_table:
+            self.cell_order_table = ti.field(dtype=ti.i32, shape=total_grid_num)
+            self.cell_order_table.from_numpy(space_filling_curve.cell_order_table(self.grid_num, self.cell_ordering))
         self.counting_sort_countArray = ti.field(dtype=ti.i32, shape=total_grid_num)
         self.counting_sort_accumulatedArray = ti.field(dtype=ti.i32, shape=total_grid_num)
-        self.prefix_sum_executor = ti.algorithms.PrefixSumExecutor(self.counting_sort_accumulatedArray.shape[0])
+        self.prefix_sum_executor = make_prefix_sum_executor(self.counting_sort_accumulatedArray.shape[0])
+        # SPHBase.run_steps scans inside its own kernel, which only the blocked prefix sum can do
+        self.blocked_prefix_sum_executor = self.prefix_sum_executor
+        if not isinstance(self.prefix_sum_executor, BlockedPrefixSumExecutor):
+            self.blocked_prefix_sum_executor = BlockedPrefixSumExecutor(total_grid_num)
         # Don't know why but ti.algorithms.PrefixSumExecutor(total_grid_num) is error.
+        # Grid of the static rigid particles. Cells are indexed like the dynamic grid, particle ranges are relative
+        # to dynamic_particle_num where the static particles start.
+        self.static_counting_sort_countArray = ti.field(dtype=ti.i32, shape=total_grid_num)
+        self.static_counting_sort_accumulatedArray = ti.field(dtype=ti.i32, shape=total_grid_num)
+
+        # Neighbor list related. Only fluid particles look up their neighbors during a step, so rows are handed out
+        # to fluid particles only and neighbor_list_row maps a particle index to its row (-1 if it has none).
+        if self.use_neighbor_list:
+            neighbor_list_row_num = max(self.fluid_particle_capacity, 1)
+            self.neighbor_list = ti.field(dtype=ti.i32, shape=(neighbor_list_row_num, self.max_neighbor_num))
+            self.neighbor_num = ti.field(dtype=ti.i32, shape=neighbor_list_row_num)
+            self.neighbor_list_row = ti.field(dtype=ti.i32, shape=max(self.dynamic_particle_num, 1))
+            self.neighbor_list_row_cnt = ti.field(dtype=ti.i32, shape=())
+            self.neighbor_list_position = ti.Vector.field(self.dim, dtype=ti.f32,
+                                                          shape=max(self.dynamic_particle_num, 1))
+            self.neighbor_list_max_displacement = ti.field(dtype=ti.f32, shape=())
+            self.neighbor_list_overflow = ti.field(dtype=ti.i32, shape=())
+            # Set on the device when particles are spawned or removed, forces the next rebuild
+            self.neighbor_list_expired = ti.field(dtype=ti.i32, shape=())
+        self.neighbor_list_dirty = True
+
+        # Stream compaction of the dynamic range, see delete_particles
+        if self.use_particle_deletion:
+            self.survivor_prefix_sum = ti.field(dtype=ti.i32, shape=max(self.dynamic_particle_num, 1))
+            self.survivor_prefix_sum_executor = make_prefix_sum_executor(self.survivor_prefix_sum.shape[0])
+            self.compaction_end = ti.field(dtype=ti.i32, shape=())
+            self.deleted_particle_num = ti.field(dtype=ti.i32, shape=())
 
         self.grid_id = ti.field(dtype=ti.i32, shape=self.total_particle_num)
-        self.grid_id_buffer = ti.field(dtype=ti.i32, shape=self.total_particle_num)
-        self.grid_id_for_sort = ti.field(dtype=ti.i32, shape=self.total_particle_num)
+        self.sorted_order = ti.field(dtype=ti.i32, shape=self.total_particle_num)  # old index of each sorted slot
 
         # Particle Related
-        self.object_id = ti.field(dtype=ti.i32, shape=self.total_particle_num)
-
-        self.velocity = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
-        self.acceleration = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
-
-        self.volume = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.mass = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.density = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.pressure = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-
-        self.is_dynamic = ti.field(dtype=ti.i32, shape=self.total_particle_num)
+        self.add_particle_attribute('object_id', ti.i32)
 
-        # Buffer for sort
-        self.object_id_buffer = ti.field(dtype=ti.i32, shape=self.total_particle_num)
+        self.add_particle_attribute('velocity', ti.f32, self.dim)
+        self.add_particle_attribute('acceleration', ti.f32, self.dim)
 
-        self.position_buffer = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
-        self.velocity_buffer = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
-        self.acceleration_buffer = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_particle_num)
+        self.add_particle_attribute('volume', ti.f32)
+        self.add_particle_attribute('mass', ti.f32)
+        self.add_particle_attribute('density', ti.f32)
+        self.add_particle_attribute('pressure', ti.f32)
 
-        self.volume_buffer = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.mass_buffer = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.density_buffer = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.pressure_buffer = ti.field(dtype=ti.f32, shape=self.total_particle_num)
-        self.material_buffer = ti.field(dtype=ti.i32, shape=self.total_particle_num)
+        self.add_particle_attribute('is_dynamic', ti.i32)
+        if self.use_emitter:
+            # Ring slot of particles spawned by the emitter, -1 for all others
+            self.add_particle_attribute('emitter_slot', ti.i32)
 
-        self.color_buffer = ti.Vector.field(3, dtype=ti.f32, shape=self.total_particle_num)
-        self.is_dynamic_buffer = ti.field(dtype=ti.i32, shape=self.total_particle_num)
+        # Buffer for sort, one per dtype and width shared by every attribute of that kind
+        sort_buffer_size = max(self.dynamic_particle_num, self.total_static_rigid_particle_num, 1)
+        for attribute in self.particle_attributes.values():
+            if attribute not in self.sort_buffers:
+                self.sort_buffers[attribute] = self.allocate_particle_field(*attribute, shape=sort_buffer_size)
 
         # Memory allocation for object mesh rendering
-        self.fluid_only_color = ti.Vector.field(3, dtype=ti.f32, shape=self.total_fluid_particle_num)
-        self.fluid_only_position = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.total_fluid_particle_num)
+        self.fluid_only_color = ti.Vector.field(3, dtype=ti.f32, shape=self.fluid_particle_capacity)
+        self.fluid_only_position = ti.Vector.field(self.dim, dtype=ti.f32, shape=self.fluid_particle_capacity)
         self.tmp_cnt = ti.field(ti.i32, shape=())
 
         # ========== Initialize particles ==========#
@@ -195,7 +376,7 @@ class ParticleSystem:
                                is_dynamic=np.full((fluid_particle_num,), 1, dtype=np.int32))
 
         # Rigid bodies
-        for rigid_body in self.rigidBodiesConfig:
+        for rigid_body in self.allocate_rigid_bodies():
 
             rigid_body_particle_num = rigid_body['particleNum']
             rigid_body_is_dynamic = 1 if rigid_body['isDynamic'] else 0
@@ -223,42 +404,110 @@ class ParticleSystem:
         del self.mesh_indices
         del self.rigid_bodies_sigma
 
+        if self.use_cell_order_table:
+            del self.cell_order_table
         del self.counting_sort_countArray
         del self.counting_sort_accumulatedArray
         del self.prefix_sum_executor
+        del self.blocked_prefix_sum_executor
+        del self.static_counting_sort_countArray
+        del self.static_counting_sort_accumulatedArray
+
+        if self.use_neighbor_list:
+            del self.neighbor_list
+            del self.neighbor_num
+            del self.neighbor_list_row
+            del self.neighbor_list_row_cnt
+            del self.neighbor_list_position
+            del self.neighbor_list_max_displacement
+            del self.neighbor_list_overflow
+            del self.neighbor_list_expired
+
+        if self.use_particle_deletion:
+            del self.survivor_prefix_sum
+            del self.survivor_prefix_sum_executor
+            del self.compaction_end
+            del self.deleted_particle_num
 
         del self.grid_id
-        del self.grid_id_buffer
-        del self.grid_id_for_sort
-
-        del self.object_id
-        del self.position
-        del self.velocity
-        del self.acceleration
-        del self.volume
-        del self.mass
-        del self.density
-        del self.pressure
-        del self.material
-        del self.color
-        del self.is_dynamic
-
-        del self.object_id_buffer
-        del self.position_buffer
-        del self.velocity_buffer
-        del self.acceleration_buffer
-        del self.volume_buffer
-        del self.mass_buffer
-        del self.density_buffer
-        del self.pressure_buffer
-        del self.material_buffer
-        del self.color_buffer
-        del self.is_dynamic_buffer
+        del self.sorted_order
+
+        for name in self.particle_attributes:
+            delattr(self, name)
+        self.particle_attributes = dict()
+        self.sort_buffers = dict()
 
         del self.fluid_only_color
         del self.fluid_only_position
         del self.tmp_cnt
 
+    @staticmethod
+    def is_density_map_body(rigid_body):
+        return rigid_body.get('boundaryModel', 'particles') == 'densityMap'
+
+    def rigid_bodies_in_memory_order(self):
+        # Dynamic rigid bodies go right after the fluid, static ones last. Density map bodies have no particles.
+        particle_bodies = [rigid_body for rigid_body in self.rigidBodiesConfig
+                           if not self.is_density_map_body(rigid_body)]
+        return sorted(particle_bodies, key=lambda rigid_body: not rigid_body['isDynamic'])
+
+    def allocate_rigid_bodies(self):
+        # rigid_bodies_in_memory_order, skipping the emitter slots right before the first static body
+        for rigid_body in self.rigid_bodies_in_memory_order():
+            if not rigid_body['isDynamic']:
+                self.memory_allocated_particle_num[None] = max(self.memory_allocated_particle_num[None],
+                                                               self.dynamic_particle_num)
+            yield rigid_body
+
+    def allocate_particle_field(self, dtype, n, shape=None):
+        shape = self.total_particle_num if shape is None else shape
+        if n == 1:
+            return ti.field(dtype=dtype, shape=shape)
+        return ti.Vector.field(n, dtype=dtype, shape=shape)
+
+    def add_particle_attribute(self, name, dtype, n=1):
+        """
+        Allocate a per-particle field with n components as self.<name> and register it, so it is reordered together
+        with the position in counting_sort and released in free_memory_allocation.
+        """
+        dtype = self.attribute_storage.get(name, dtype)
+        setattr(self, name, self.allocate_particle_field(dtype, n))
+        self.particle_attributes[name] = (dtype, n)
+
+    def memory_usage_report(self):
+        """
+        Bytes held by the per-particle attributes and their sort buffers, next to what the same fields take with
+        every component stored at 32 bits.
+        """
+        attribute_bytes = 0
+        full_attribute_bytes = 0
+        for dtype, n in self.particle_attributes.values():
+            attribute_bytes += self.total_particle_num * n * dtype_size(dtype)
+            full_attribute_bytes += self.total_particle_num * n * 4
+        sort_buffer_size = max(self.dynamic_particle_num, self.total_static_rigid_particle_num, 1)
+        sort_buffer_bytes = sum(sort_buffer_size * n * dtype_size(dtype) for dtype, n in self.sort_buffers)
+        # With 32 bit storage the buffers are shared per (float or integer, width)
+        full_sort_buffers = set((ti.types.is_integral(dtype), n) for dtype, n in self.sort_buffers)
+        full_sort_buffer_bytes = sum(sort_buffer_size * n * 4 for _, n in full_sort_buffers)
+        total = attribute_bytes + sort_buffer_bytes
+        full_total = full_attribute_bytes + full_sort_buffer_bytes
+        return 'Particle memory ({} profile, {} particles): {:.2f} MB attributes + {:.2f} MB sort buffers, ' \
+               '{:.1f}% of the full profile ({:.2f} MB)'.format(
+                   self.storage_profile, self.total_particle_num, attribute_bytes / 2 ** 20,
+                   sort_buffer_bytes / 2 ** 20, 100.0 * total / full_total, full_total / 2 ** 20)
+
+    def compute_hash_table_size(self):
+        """
+        Power of two (so the hash can be masked) with twice as many buckets as cells the particles would occupy when
+        packed at rest spacing. Collisions only cost extra candidates, the neighbor search filters them out.
+        """
+        if 'hashTableSize' in self.config:
+            table_size = self.config['hashTableSize']
+        else:
+            particle_per_cell = max((self.grid_size / self.particle_diameter) ** self.dim, 1.0)
+            table_size = 2 * int(np.ceil(self.total_particle_num / particle_per_cell))
+        return 1 << max(int(np.ceil(np.log2(max(table_size, 1)))), 0)
+
     def compute_fluid_particle_num(self, start, end):
         particle_num = 1
         for i in range(self.dim):
@@ -268,14 +517,14 @@ class ParticleSystem:
     @ti.kernel
     def update_fluid_position_info(self):
         self.tmp_cnt[None] = 0
-        for i in self.position:
+        for i in range(self.active_particle_num[None]):
             if self.material[i] == self.material_fluid:
                 self.fluid_only_position[ti.atomic_add(self.tmp_cnt[None], 1)] = self.position[i]
 
     @ti.kernel
     def update_fluid_color_info(self):
         self.tmp_cnt[None] = 0
-        for i in self.color:
+        for i in range(self.active_particle_num[None]):
             if self.material[i] == self.material_fluid:
                 self.fluid_only_color[ti.atomic_add(self.tmp_cnt[None], 1)] = self.color[i]
 
@@ -300,6 +549,23 @@ class ParticleSystem:
         self.mesh_indices.append(ti_mesh_indices)
 
     def load_rigid_body(self, rigid_body):
+        preloaded = self.preloaded_rigid_bodies.get(rigid_body['objectId'])
+        if preloaded is not None:
+            mesh = tm.Trimesh(vertices=preloaded['vertices'], faces=preloaded['faces'], process=False)
+            rigid_body['mesh'] = mesh.copy()
+            self.get_mesh_info(mesh)
+            return preloaded['points']
+
+        cache_key = None
+        if self.voxel_cache is not None:
+            cache_key = self.voxel_cache.key(rigid_body, self.particle_diameter)
+            cached = self.voxel_cache.load(cache_key)
+            if cached is not None:
+                mesh = tm.Trimesh(vertices=cached['vertices'], faces=cached['faces'], process=False)
+                rigid_body['mesh'] = mesh.copy()
+                self.get_mesh_info(mesh)
+                return cached['points']
+
         mesh = tm.load(rigid_body['geometryFile'])
         mesh.apply_scale(rigid_body['scale'])
         offset = np.array(rigid_body['translation'])
@@ -310,8 +576,21 @@ class ParticleSystem:
         mesh.vertices += offset
         rigid_body['mesh'] = mesh.copy()
         self.get_mesh_info(mesh)
-        voxelized_mesh = mesh.voxelized(pitch=self.particle_diameter).fill()
-        return voxelized_mesh.points.astype(np.float32)
+        voxelizer_name = rigid_body.get('voxelizer', 'trimesh')
+        start_time = time.perf_counter()
+        if voxelizer_name == 'trimesh':
+            voxelized_mesh = mesh.voxelized(pitch=self.particle_diameter).fill()
+            voxelized_points = voxelized_mesh.points.astype(np.float32)
+        elif voxelizer_name == 'parallel':
+            voxelized_points = voxelizer.voxelize(mesh, self.particle_diameter,
+                                                  self.voxelizer_worker_num).astype(np.float32)
+        else:
+            raise ValueError('Unknown voxelizer: {}'.format(voxelizer_name))
+        print('Voxelized {} with the {} voxelizer: {} points in {:.2f} s'.format(
+            rigid_body['geometryFile'], voxelizer_name, voxelized_points.shape[0], time.perf_counter() - start_time))
+        if cache_key is not None:
+            self.voxel_cache.store(cache_key, voxelized_points, mesh.vertices, mesh.faces)
+        return voxelized_points
 
     @ti.kernel
     def add_particles_only_position(self,
@@ -329,8 +608,8 @@ class ParticleSystem:
             for dim_idx in ti.static(range(3)):
                 col[dim_idx] = color[relative_idx, dim_idx]
             self.position[idx] = pos
-            self.material[idx] = material[relative_idx]
-            self.color[idx] = col
+            self.material[idx] = ti.cast(material[relative_idx], self.material.dtype)
+            self.color[idx] = ti.cast(col, self.color.dtype)
         self.memory_allocated_particle_num[None] += particle_num
 
     @ti.kernel
@@ -348,7 +627,7 @@ class ParticleSystem:
             acc = ti.Vector.zero(ti.f32, self.dim)
             for dim_idx in ti.static(range(self.dim)):
                 vel[dim_idx] = velocity[relative_idx, dim_idx]
-            self.object_id[idx] = object_id
+            self.object_id[idx] = ti.cast(object_id, self.object_id.dtype)
             self.velocity[idx] = vel
             self.acceleration[idx] = acc
 
@@ -356,7 +635,9 @@ class ParticleSystem:
             self.density[idx] = density[relative_idx]
             self.mass[idx] = self.volume[idx] * self.density[idx]
             self.pressure[idx] = pressure[relative_idx]
-            self.is_dynamic[idx] = is_dynamic[relative_idx]
+            self.is_dynamic[idx] = ti.cast(is_dynamic[relative_idx], self.is_dynamic.dtype)
+            if ti.static(self.use_emitter):
+                self.emitter_slot[idx] = -1
         self.memory_allocated_particle_num[None] += particle_num
 
     def add_cube(self, box_start, box_end, color, material):
@@ -393,7 +674,21 @@ class ParticleSystem:
 
     @ti.func
     def pos2index(self, position):
-        return (position / self.grid_size).cast(ti.i32)
+        grid_idx = (position / self.grid_size).cast(ti.i32)
+        if ti.static(not self.use_hashed_grid):
+            # Particles outside of the domain (e.g. rigid body parts) are kept in the outermost cells.
+            for d in ti.static(range(self.dim)):
+                grid_idx[d] = ti.min(ti.max(grid_idx[d], 0), self.grid_num[d] - 1)
+        return grid_idx
+
+    @ti.func
+    def is_valid_grid_index(self, grid_idx):
+        valid = True
+        if ti.static(not self.use_hashed_grid):
+            for d in ti.static(range(self.dim)):
+                if grid_idx[d] < 0 or grid_idx[d] >= self.grid_num[d]:
+                    valid = False
+        return valid
 
     @ti.func
     def flatten_grid_index(self, grid_idx):
@@ -406,77 +701,294 @@ class ParticleSystem:
             flatten_grid_idx = grid_idx[0] * self.grid_num[1] + grid_idx[1]
         return flatten_grid_idx
 
+    @ti.func
+    def hash_grid_index(self, grid_idx):
+        """
+        Optimized Spatial Hashing for Collision Detection of Deformable Objects, Teschner et al. 2003
+        """
+        hash_value = grid_idx[0] * 73856093 ^ grid_idx[1] * 19349663
+        if ti.static(self.dim == 3):
+            hash_value ^= grid_idx[2] * 83492791
+        return hash_value & self.hash_table_mask
+
+    @ti.func
+    def morton_grid_index(self, grid_idx):
+        """
+        Z-order code of the lowest 10 bits of each cell coordinate. Masking it keeps nearby cells in nearby buckets.
+        """
+        code = 0
+        for b in ti.static(range(10)):
+            for d in ti.static(range(self.dim)):
+                code |= ((grid_idx[d] >> b) & 1) << (b * self.dim + self.dim - 1 - d)
+        return code & self.hash_table_mask
+
+    @ti.func
+    def get_cell_index(self, grid_idx):
+        cell_idx = 0
+        if ti.static(self.use_hashed_grid):
+            if ti.static(self.cell_ordering == 'morton'):
+                cell_idx = self.morton_grid_index(grid_idx)
+            else:
+                cell_idx = self.hash_grid_index(grid_idx)
+        elif ti.static(self.use_cell_order_table):
+            cell_idx = self.cell_order_table[self.flatten_grid_index(grid_idx)]
+        else:
+            cell_idx = self.flatten_grid_index(grid_idx)
+        return cell_idx
+
     @ti.func
     def get_grid_idx_from_pos(self, position):
         grid_idx = self.pos2index(position)  # floor operation
-        return self.flatten_grid_index(grid_idx)
+        return self.get_cell_index(grid_idx)
 
     @ti.kernel
-    def update_grid_id(self):
-        self.counting_sort_accumulatedArray.fill(0)
-        for i in self.position:
+    def update_grid_id(self, particle_begin: int, particle_end: ti.template(),
+                       countArray: ti.template(), accumulatedArray: ti.template()):
+        self.update_grid_id_stage(particle_begin, particle_end, countArray, accumulatedArray)
+
+    @ti.func
+    def update_grid_id_stage(self, particle_begin, particle_end: ti.template(),
+                             countArray: ti.template(), accumulatedArray: ti.template()):
+        accumulatedArray.fill(0)
+        for i in range(particle_begin, particle_end[None]):
             self.grid_id[i] = self.get_grid_idx_from_pos(self.position[i])
-            self.counting_sort_accumulatedArray[self.grid_id[i]] += 1
-        for i in self.counting_sort_accumulatedArray:
-            self.counting_sort_countArray[i] = self.counting_sort_accumulatedArray[i]
+            accumulatedArray[self.grid_id[i]] += 1
+        for i in accumulatedArray:
+            countArray[i] = accumulatedArray[i]
 
     @ti.kernel
-    def counting_sort(self):
-        for i in range(self.total_particle_num):
+    def counting_sort(self, particle_begin: int, particle_end: ti.template(),
+                      countArray: ti.template(), accumulatedArray: ti.template()):
+        self.counting_sort_stage(particle_begin, particle_end, countArray, accumulatedArray)
+
+    @ti.func
+    def counting_sort_stage(self, particle_begin, particle_end: ti.template(),
+                            countArray: ti.template(), accumulatedArray: ti.template()):
+        for i in range(particle_begin, particle_end[None]):
             grid_idx = self.grid_id[i]
-            base_offset = 0 if grid_idx == 0 else self.counting_sort_accumulatedArray[grid_idx - 1]
-            self.grid_id_for_sort[i] = ti.atomic_sub(self.counting_sort_countArray[grid_idx], 1) + base_offset - 1
-        for i in self.grid_id_for_sort:
-            new_idx = self.grid_id_for_sort[i]
-            self.grid_id_buffer[new_idx] = self.grid_id[i]
-
-            self.object_id_buffer[new_idx] = self.object_id[i]
-            self.position_buffer[new_idx] = self.position[i]
-            self.velocity_buffer[new_idx] = self.velocity[i]
-            self.acceleration_buffer[new_idx] = self.acceleration[i]
-
-            self.volume_buffer[new_idx] = self.volume[i]
-            self.density_buffer[new_idx] = self.density[i]
-            self.mass_buffer[new_idx] = self.mass[i]
-            self.pressure_buffer[new_idx] = self.pressure[i]
-            self.material_buffer[new_idx] = self.material[i]
-
-            self.color_buffer[new_idx] = self.color[i]
-            self.is_dynamic_buffer[new_idx] = self.is_dynamic[i]
-
-        for i in self.grid_id:
-            self.grid_id[i] = self.grid_id_buffer[i]
-
-            self.object_id[i] = self.object_id_buffer[i]
-            self.position[i] = self.position_buffer[i]
-            self.velocity[i] = self.velocity_buffer[i]
-            self.acceleration[i] = self.acceleration_buffer[i]
-
-            self.volume[i] = self.volume_buffer[i]
-            self.density[i] = self.density_buffer[i]
-            self.mass[i] = self.mass_buffer[i]
-            self.pressure[i] = self.pressure_buffer[i]
-            self.material[i] = self.material_buffer[i]
-
-            self.color[i] = self.color_buffer[i]
-            self.is_dynamic[i] = self.is_dynamic_buffer[i]
+            base_offset = 0 if grid_idx == 0 else accumulatedArray[grid_idx - 1]
+            new_idx = ti.atomic_sub(countArray[grid_idx], 1) + base_offset - 1
+            self.sorted_order[particle_begin + new_idx] = i
+
+    def particle_attribute_sort_pairs(self):
+        return [(getattr(self, name), self.sort_buffers[attribute]) for name, attribute in
+                self.particle_attributes.items()]
+
+    @ti.kernel
+    def reorder_particle_attributes(self, particle_begin: int, particle_end: ti.template()):
+        self.reorder_particle_attributes_stage(particle_begin, particle_end)
 
     @ti.func
-    def for_all_neighbors(self, idx_i, task: ti.template(), ret: ti.template()):
+    def reorder_particle_attributes_stage(self, particle_begin, particle_end: ti.template()):
+        """
+        Gather every registered attribute into sorted order. Attributes of the same dtype and width go one after
+        another through the same buffer, top-level loops of a kernel run in order so this is safe.
+        """
+        for attribute, buffer in ti.static(self.particle_attribute_sort_pairs()):
+            for i in range(particle_begin, particle_end[None]):
+                buffer[i - particle_begin] = attribute[self.sorted_order[i]]
+            for i in range(particle_begin, particle_end[None]):
+                attribute[i] = buffer[i - particle_begin]
+
+    @ti.func
+    def search_cell(self, idx_i, radius, grid_idx, grid_flatten_idx, particle_offset,
+                    accumulatedArray: ti.template(), task: ti.template(), ret: ti.template()):
+        start_idx = 0 if grid_flatten_idx == 0 else accumulatedArray[grid_flatten_idx - 1]
+        # TODO: can we somewhat modify to enable using ti.static?
+        for idx_j in range(particle_offset + start_idx, particle_offset + accumulatedArray[grid_flatten_idx]):
+            if ti.static(self.use_hashed_grid):
+                # A bucket can hold several cells, and two cells of the stencil can share a bucket.
+                # Only take particles that really lie in this cell so nobody is visited twice.
+                if (self.pos2index(self.position[idx_j]) != grid_idx).any():
+                    continue
+            if idx_i != idx_j and (self.position[idx_i] - self.position[idx_j]).norm() < radius:
+                task(idx_i, idx_j, ret)
+
+    @ti.func
+    def search_grid(self, idx_i, radius, task: ti.template(), ret: ti.template()):
         center_cell_grid_idx = self.pos2index(self.position[idx_i])
         for offset in ti.grouped(ti.ndrange(*(((-1, 2),) * self.dim))):
-            neighbor_grid_flatten_idx = self.flatten_grid_index(offset + center_cell_grid_idx)
-            start_idx = 0 if neighbor_grid_flatten_idx == 0 else self.counting_sort_accumulatedArray[
-                neighbor_grid_flatten_idx - 1]
-            # TODO: can we somewhat modify to enable using ti.static?
-            for idx_j in range(start_idx, self.counting_sort_accumulatedArray[neighbor_grid_flatten_idx]):
-                if idx_i != idx_j and (self.position[idx_i] - self.position[idx_j]).norm() < self.support_length:
+            neighbor_grid_idx = offset + center_cell_grid_idx
+            if self.is_valid_grid_index(neighbor_grid_idx):
+                neighbor_grid_flatten_idx = self.get_cell_index(neighbor_grid_idx)
+                self.search_cell(idx_i, radius, neighbor_grid_idx, neighbor_grid_flatten_idx, 0,
+                                 self.counting_sort_accumulatedArray, task, ret)
+                if ti.static(self.total_static_rigid_particle_num > 0):
+                    self.search_cell(idx_i, radius, neighbor_grid_idx, neighbor_grid_flatten_idx,
+                                     self.dynamic_particle_num, self.static_counting_sort_accumulatedArray, task, ret)
+
+    @ti.func
+    def for_all_neighbors_in_grid(self, idx_i, task: ti.template(), ret: ti.template()):
+        """
+        Neighbor query through the sorted grid. Always valid right after update_particle_system sorted particles,
+        which is the case in SPHBase.initialize, so use this there even in neighbor list mode.
+        """
+        self.search_grid(idx_i, self.support_length, task, ret)
+
+    @ti.func
+    def for_all_neighbors(self, idx_i, task: ti.template(), ret: ti.template()):
+        if ti.static(self.use_neighbor_list):
+            # Neighbor list mode only keeps rows for fluid particles.
+            row = self.neighbor_list_row[idx_i]
+            for k in range(self.neighbor_num[row]):
+                idx_j = self.neighbor_list[row, k]
+                if (self.position[idx_i] - self.position[idx_j]).norm() < self.support_length:
                     task(idx_i, idx_j, ret)
+        else:
+            self.for_all_neighbors_in_grid(idx_i, task, ret)
+
+    @ti.func
+    def add_neighbor_task(self, p_i, p_j, cnt: ti.template()):
+        if cnt < self.max_neighbor_num:
+            self.neighbor_list[self.neighbor_list_row[p_i], cnt] = p_j
+        cnt += 1
+
+    @ti.kernel
+    def build_neighbor_list(self):
+        self.neighbor_list_row_cnt[None] = 0
+        self.neighbor_list_overflow[None] = 0
+        self.neighbor_list_expired[None] = 0
+        for i in range(self.active_particle_num[None]):
+            self.neighbor_list_position[i] = self.position[i]
+            self.neighbor_list_row[i] = -1
+            if self.material[i] == self.material_fluid:
+                row = ti.atomic_add(self.neighbor_list_row_cnt[None], 1)
+                self.neighbor_list_row[i] = row
+                cnt = 0
+                self.search_grid(i, self.neighbor_search_radius, self.add_neighbor_task, cnt)
+                self.neighbor_num[row] = ti.min(cnt, self.max_neighbor_num)
+                ti.atomic_max(self.neighbor_list_overflow[None], cnt)
+
+    @ti.kernel
+    def compute_neighbor_list_max_displacement(self):
+        self.neighbor_list_max_displacement[None] = 0.0
+        for i in range(self.active_particle_num[None]):
+            if self.is_dynamic[i]:
+                ti.atomic_max(self.neighbor_list_max_displacement[None],
+                              (self.position[i] - self.neighbor_list_position[i]).norm())
+        if self.neighbor_list_expired[None]:
+            self.neighbor_list_max_displacement[None] = self.neighbor_list_skin
+
+    def neighbor_list_needs_rebuild(self):
+        if self.neighbor_list_dirty:
+            return True
+        self.compute_neighbor_list_max_displacement()
+        return self.neighbor_list_max_displacement[None] > 0.5 * self.neighbor_list_skin
+
+    def sort_particles(self, particle_begin, particle_end, countArray, accumulatedArray):
+        self.update_grid_id(particle_begin, particle_end, countArray, accumulatedArray)
+        self.prefix_sum_executor.run(accumulatedArray)
+        self.counting_sort(particle_begin, particle_end, countArray, accumulatedArray)
+        self.reorder_particle_attributes(particle_begin, particle_end)
+
+    @ti.func
+    def sort_dynamic_particles_stage(self):
+        """
+        rebuild_neighbor_search without neighbor list, for SPHBase.run_steps. The scan has to run inside the kernel,
+        so it always uses the blocked prefix sum.
+        """
+        self.update_grid_id_stage(0, self.active_particle_num,
+                                  self.counting_sort_countArray, self.counting_sort_accumulatedArray)
+        self.blocked_prefix_sum_executor.inclusive_scan(self.counting_sort_accumulatedArray,
+                                                        self.counting_sort_accumulatedArray.shape[0])
+        self.counting_sort_stage(0, self.active_particle_num,
+                                 self.counting_sort_countArray, self.counting_sort_accumulatedArray)
+        self.reorder_particle_attributes_stage(0, self.active_particle_num)
+
+    def build_static_grid(self):
+        """
+        Sort the static rigid particles into their own grid. They never move, so this is done once in
+        SPHBase.initialize and update_particle_system only has to handle the dynamic particles.
+        """
+        self.sort_particles(self.dynamic_particle_num, self.static_particle_end,
+                            self.static_counting_sort_countArray, self.static_counting_sort_accumulatedArray)
+
+    @ti.func
+    def is_particle_dead(self, p):
+        dead = False
+        if self.material[p] == self.material_fluid:
+            if ti.static(self.delete_at_domain_boundary):
+                # enforce_boundary keeps particles at most on the padding planes
+                for d in ti.static(range(self.dim)):
+                    if ti.static(self.deletion_wall_lower[d]):
+                        if self.position[p][d] <= self.padding:
+                            dead = True
+                    if ti.static(self.deletion_wall_upper[d]):
+                        if self.position[p][d] >= self.domain_end[d] - self.padding:
+                            dead = True
+            if ti.static(self.max_lifetime > 0):
+                if self.lifetime[p] > self.max_lifetime:
+                    dead = True
+            if ti.static(self.use_deletion_temperature):
+                if self.temperature[p] <= self.deletion_temperature:
+                    dead = True
+        return dead
+
+    @ti.kernel
+    def mark_surviving_particles(self):
+        for i in range(self.survivor_prefix_sum.shape[0]):
+            survives = 0
+            if i < self.active_particle_num[None]:
+                if not self.is_particle_dead(i):
+                    survives = 1
+            self.survivor_prefix_sum[i] = survives
+
+    @ti.kernel
+    def compute_compaction_order(self):
+        for i in range(self.active_particle_num[None]):
+            new_idx = self.survivor_prefix_sum[i] - 1
+            if i == 0 or self.survivor_prefix_sum[i - 1] == new_idx:
+                if new_idx >= 0:
+                    self.sorted_order[new_idx] = i
+        survivor_num = self.survivor_prefix_sum[self.survivor_prefix_sum.shape[0] - 1]
+        deleted_num = self.active_particle_num[None] - survivor_num
+        # Nothing to move when nobody died
+        self.compaction_end[None] = 0
+        if deleted_num > 0:
+            self.compaction_end[None] = survivor_num
+            self.active_particle_num[None] = survivor_num
+            self.deleted_particle_num[None] += deleted_num
+            if ti.static(self.use_neighbor_list):
+                self.neighbor_list_expired[None] = 1
+
+    def delete_particles(self):
+        """
+        Remove dead particles and pack the survivors, in their current order, to the front of the dynamic range. The
+        inclusive prefix sum over the survivor flags gives each survivor its new index and the gather reuses
+        reorder_particle_attributes. Emitter slots of deleted particles become free again.
+        """
+        self.mark_surviving_particles()
+        self.survivor_prefix_sum_executor.run(self.survivor_prefix_sum)
+        self.compute_compaction_order()
+        self.reorder_particle_attributes(0, self.compaction_end)
 
     def update_particle_system(self):
-        self.update_grid_id()
-        self.prefix_sum_executor.run(self.counting_sort_accumulatedArray)
-        self.counting_sort()
+        if self.use_particle_deletion:
+            self.deletion_step += 1
+            if self.deletion_step % self.deletion_interval == 0:
+                self.delete_particles()
+        if self.use_neighbor_list and not self.neighbor_list_needs_rebuild():
+            # Every neighbor is still inside the list radius, so the grid and the particle order can stay as they are.
+            return
+        self.rebuild_neighbor_search()
+
+    def rebuild_neighbor_search(self):
+        self.sort_particles(0, self.active_particle_num,
+                            self.counting_sort_countArray, self.counting_sort_accumulatedArray)
+        if self.use_neighbor_list:
+            self.build_neighbor_list()
+            self.neighbor_list_dirty = False
+            if self.neighbor_list_overflow[None] > self.max_neighbor_num:
+                print('Warning: {} neighbors found but maxNeighborNum is {}. Some neighbors are dropped.'.format(
+                    self.neighbor_list_overflow[None], self.max_neighbor_num))
+
+    def rebuild_expired_neighbor_list(self):
+        """
+        Particles added since the last build have no row in the neighbor list, for_all_neighbors would read another
+        particle's row for them. Called right after adding particles, so every query sees a valid list.
+        """
+        if self.use_neighbor_list and self.neighbor_list_expired[None]:
+            self.rebuild_neighbor_search()
 
     @ti.func
     def is_static_rigid_body(self, p):
@@ -491,6 +1003,12 @@ class ParticleSystem:
 
     def reset_particle_system(self):
         self.memory_allocated_particle_num[None] = 0
+        self.active_particle_num[None] = self.dynamic_particle_num - self.emitter_capacity
+        self.neighbor_list_dirty = True
+        if self.use_particle_deletion:
+            self.deletion_step = 0
+            self.deleted_particle_num[None] = 0
+        self.lifetime.fill(0.0)
         for fluid in self.fluidBlocksConfig:
             offset = np.array(fluid['translation'])
             start = np.array(fluid['start'])
@@ -500,12 +1018,11 @@ class ParticleSystem:
                 color = [c / 255.0 for c in color]
             self.add_cube(box_start=start + offset, box_end=end + offset, color=color, material=self.material_fluid)
 
-        for rigid_body in self.rigidBodiesConfig:
+        for rigid_body in self.allocate_rigid_bodies():
             rigid_body_particle_num = rigid_body['particleNum']
             color = rigid_body['color']
             if type(color[0]) == int:
                 color = [c / 255.0 for c in color]
-            density = rigid_body['density']
             self.add_particles_only_position(
                 particle_num=rigid_body_particle_num,
                 position=rigid_body['voxelizedPoints'],
@@ -524,12 +1041,14 @@ class ParticleSystem:
                                pressure=np.full((fluid_particle_num,), 0.0, dtype=np.float32),
                                is_dynamic=np.full((fluid_particle_num,), 1, dtype=np.int32))
 
-        for rigid_body in self.rigidBodiesConfig:
+        for rigid_body in self.allocate_rigid_bodies():
+            rigid_body_particle_num = rigid_body['particleNum']
             rigid_body_is_dynamic = 1 if rigid_body['isDynamic'] else 0
             if rigid_body_is_dynamic:
                 velocity = np.tile(np.array(rigid_body['velocity'], dtype=np.float32), (rigid_body_particle_num, 1))
             else:
                 velocity = np.full((rigid_body_particle_num, self.dim), 0.0, dtype=np.float32)
+            density = rigid_body['density']
             self.add_particles(object_id=rigid_body['objectId'],
                                particle_num=rigid_body_particle_num,
                                velocity=velocity,
@@ -537,42 +1056,47 @@ class ParticleSystem:
                                pressure=np.full((rigid_body_particle_num,), 0.0, dtype=np.float32),
                                is_dynamic=np.full((rigid_body_particle_num,), rigid_body_is_dynamic, dtype=np.int32))
 
+        self.initialize_temperature(1200.0)
+
     def dump(self):
-        return self.fluid_only_position.to_numpy()
+        # Call update_fluid_position_info first, it counts the fluid particles in use into tmp_cnt
+        return self.fluid_only_position.to_numpy()[:self.tmp_cnt[None]]
 
     def add_particle(self, position, velocity):
         """
-        Add a single particle dynamically to the system.
+        Add a single lava particle dynamically to the system. It takes the next emitter slot, so the scene needs an
+        Emitter with some capacity.
 
         Args:
             position (list): [x, y, z] coordinates of the particle.
             velocity (list): [vx, vy, vz] initial velocity of the particle.
         """
-        self.position[self.total_fluid_particle_num] = position
-        self.velocity[self.total_fluid_particle_num] = velocity
-        self.total_fluid_particle_num += 1
+        if self.emitter is None:
+            raise ValueError('add_particle needs an Emitter with capacity in the scene')
+        self.emitter.add_particle(position, velocity)
 
     @ti.kernel
     def update_fluid_colors(self):
-        for i in range(self.total_particle_num):
+        for i in range(self.active_particle_num[None]):
             if self.material[i] == self.material_fluid:
                 temp = self.temperature[i]
-                self.color[i] = temperature_to_color(temp)
+                self.color[i] = ti.cast(temperature_to_color(temp), self.color.dtype)
     
     @ti.kernel
     def initialize_temperature(self, initial_temp: ti.f32):
         for i in range(self.total_particle_num):
             if self.material[i] == self.material_fluid:
-                self.temperature[i] = initial_temp
+                self.temperature[i] = ti.cast(initial_temp, self.temperature.dtype)
             else:
-                self.temperature[i] = 25.0  # Ambient temperature for solids (like the volcano)
+                # Ambient temperature for solids (like the volcano)
+                self.temperature[i] = ti.cast(25.0, self.temperature.dtype)
     
     @ti.kernel
     def cool_particles(self, cooling_rate: ti.f32):
-        for i in range(self.total_particle_num):
+        for i in range(self.active_particle_num[None]):
             if self.material[i] == self.material_fluid:
                 # Reduce temperature each step
-                self.temperature[i] = max(self.temperature[i] - cooling_rate, 25.0)
+                self.temperature[i] = ti.cast(max(self.temperature[i] - cooling_rate, 25.0), self.temperature.dtype)
     
 
 
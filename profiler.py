@@ -0,0 +1,124 @@
+#profiler.py
+import json
+import time
+import numpy as np
+import taichi as ti
+
+
+class Profiler:
+    """
+    Opt-in per-stage timing of a running simulation.
+
+    attach() replaces the instrumented methods on the particle system, solver and emitter instances by wrappers that
+    synchronize the device before and after the call and record the wall time. detach() deletes the wrappers again,
+    so the class methods are used as before and a detached or never attached profiler costs nothing.
+    Every stage keeps its last 'window' samples in a ring buffer.
+
+    Stages:
+        step                              step_batch time divided by the number of steps, launched step by step
+        update_particle_system            with deletion, grid sort and neighbor list as update_particle_system/...
+        substep/<kernel>                  every launch of the substep, see WCSPHSolver.substep_pipeline
+        enforce_boundary_3D               unfused pipeline only
+        render/update_fluid_*_info        compaction of the fluid particles for mesh rendering
+    """
+    def __init__(self, window=256):
+        self.window = window
+        self.samples = dict()
+        self.counts = dict()
+        self.installed = []
+        self.solver = None
+        self.solver_batched_steps = False
+
+    @property
+    def attached(self):
+        return self.solver is not None
+
+    def record(self, stage, seconds):
+        if stage not in self.samples:
+            self.samples[stage] = np.zeros(self.window, dtype=np.float64)
+            self.counts[stage] = 0
+        self.samples[stage][self.counts[stage] % self.window] = seconds
+        self.counts[stage] += 1
+
+    def instrument(self, owner, name, stage, per_call=None):
+        method = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            ti.sync()
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            ti.sync()
+            elapsed = time.perf_counter() - start
+            # per_call splits the time of a call into that many samples, e.g. step_batch into steps
+            self.record(stage, elapsed / per_call(*args) if per_call is not None else elapsed)
+            return result
+        timed.__name__ = name
+        setattr(owner, name, timed)
+        self.installed.append((owner, name))
+
+    def attach(self, ps, solver):
+        if self.attached:
+            self.detach()
+        # A batched step_batch runs the stages inside run_steps where they cannot be timed one by one
+        self.solver_batched_steps = solver.use_batched_steps
+        solver.use_batched_steps = False
+        self.instrument(solver, 'step_batch', 'step', per_call=lambda step_num: max(step_num, 1))
+        self.instrument(ps, 'update_particle_system', 'update_particle_system')
+        stages = ['sort_particles']
+        if ps.use_particle_deletion:
+            stages.append('delete_particles')
+        if ps.use_neighbor_list:
+            stages += ['neighbor_list_needs_rebuild', 'build_neighbor_list']
+        for name in stages:
+            self.instrument(ps, name, 'update_particle_system/' + name)
+        for launch in solver.substep_launches():
+            # Solver kernels, apart from the emitter's emit
+            owner = solver if hasattr(type(solver), launch.__name__) else solver.emitter
+            self.instrument(owner, launch.__name__, 'substep/' + launch.__name__)
+        if not solver.fused_substep:
+            self.instrument(solver, 'enforce_boundary_3D', 'enforce_boundary_3D')
+        for name in ['update_fluid_position_info', 'update_fluid_color_info']:
+            self.instrument(ps, name, 'render/' + name)
+        self.solver = solver
+
+    def detach(self):
+        for owner, name in reversed(self.installed):
+            delattr(owner, name)
+        self.installed = []
+        if self.attached:
+            self.solver.use_batched_steps = self.solver_batched_steps
+        self.solver = None
+
+    def summary(self):
+        """
+        stage -> count, last, mean and max in ms over the samples in the window, in the order stages were first seen.
+        """
+        result = dict()
+        for stage, samples in self.samples.items():
+            count = self.counts[stage]
+            window = samples[:min(count, self.window)]
+            result[stage] = {
+                'count': count,
+                'last_ms': 1000.0 * samples[(count - 1) % self.window],
+                'mean_ms': 1000.0 * float(window.mean()),
+                'max_ms': 1000.0 * float(window.max()),
+            }
+        return result
+
+    def summary_lines(self):
+        return ['{}: {:.3f} ms (max {:.3f})'.format(stage, stats['mean_ms'], stats['max_ms'])
+                for stage, stats in sorted(self.summary().items())]
+
+    def dump(self, path, **fields):
+        """
+        Append the summary as one JSON line, together with fields such as the frame number.
+        """
+        line = dict(fields)
+        line['time'] = time.time()
+        line['stages'] = self.summary()
+        with open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+    def reset(self):
+        self.samples = dict()
+        self.counts = dict()
@@ -0,0 +1,247 @@
+#replay.py
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import time
+import zipfile
+import numpy as np
+import taichi as ti
+import trimesh as tm
+import particle_system
+
+FRAME_PATTERN = re.compile(r'particle_object_0_(\d+)\.(ply|ply\.gz|npz)$')
+# Temperature of frames recorded without one, the color of fresh lava
+DEFAULT_TEMPERATURE = 1200.0
+
+
+def read_ply_header(f):
+    """
+    Format, vertex count and property names of a PLY file of float vertex properties, as written by
+    exporter.FrameExporter or ti.tools.PLYWriter. f is left at the first byte after the header.
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError('Not a PLY file')
+    ply_format, vertex_num, properties = None, 0, []
+    while True:
+        line = f.readline().strip().decode('ascii')
+        if line == 'end_header':
+            return ply_format, vertex_num, properties
+        words = line.split()
+        if words[0] == 'format':
+            ply_format = words[1]
+        elif words[0] == 'element' and words[1] == 'vertex':
+            vertex_num = int(words[2])
+        elif words[0] == 'property':
+            properties.append(words[-1])
+
+
+class FrameSequence:
+    """
+    Frames written by exporter.FrameExporter (or the former ASCII PLY output) in a directory. Uncompressed binary PLY
+    frames are memory-mapped, the others are decoded when they are shown.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        frames = []
+        for path in os.listdir(directory):
+            match = FRAME_PATTERN.match(path)
+            if match:
+                frames.append((int(match.group(1)), os.path.join(directory, path)))
+        if not frames:
+            raise ValueError('No recorded frames in {}'.format(directory))
+        self.paths = [path for _, path in sorted(frames)]
+        self.particle_num = [self.count_particles(path) for path in self.paths]
+
+        # Rigid meshes are written once as obj_<objectId>.obj, older output repeats them per frame
+        self.meshes = dict()
+        for path in sorted(glob.glob(os.path.join(directory, 'obj_*.obj'))):
+            object_id = os.path.basename(path)[len('obj_'):-len('.obj')].split('_')[0]
+            if object_id not in self.meshes:
+                self.meshes[object_id] = tm.load(path, force='mesh')
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def count_particles(path):
+        if path.endswith('.npz'):
+            with zipfile.ZipFile(path) as archive, archive.open('position.npy') as f:
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+                shape, _, _ = read_header(f)
+            return shape[0]
+        with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+            return read_ply_header(f)[1]
+
+    def read(self, frame_idx):
+        """
+        Positions (n, 3) as float32 and temperatures (n,) of a frame.
+        """
+        path = self.paths[frame_idx]
+        temperature = None
+        if path.endswith('.npz'):
+            arrays = np.load(path)
+            position = arrays['position']
+            if 'origin' in arrays:
+                position = arrays['origin'] + position.astype(np.float32) * arrays['scale']
+            if 'temperature' in arrays:
+                temperature = arrays['temperature']
+        else:
+            with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+                ply_format, vertex_num, properties = read_ply_header(f)
+                if ply_format == 'ascii':
+                    vertex = np.loadtxt(f, dtype=np.float32, ndmin=2).reshape((vertex_num, len(properties)))
+                elif path.endswith('.gz'):
+                    vertex = np.frombuffer(f.read(), dtype='<f4').reshape((vertex_num, len(properties)))
+                else:
+                    vertex = np.memmap(path, dtype='<f4', mode='r', offset=f.tell(),
+                                       shape=(vertex_num, len(properties)))
+            position = vertex[:, [properties.index(axis) for axis in 'xyz']]
+            if 'temperature' in properties:
+                temperature = vertex[:, properties.index('temperature')]
+        if temperature is None:
+            temperature = np.full(position.shape[0], DEFAULT_TEMPERATURE, dtype=np.float32)
+        return np.ascontiguousarray(position, dtype=np.float32), np.ascontiguousarray(temperature, dtype=np.float32)
+
+
+@ti.data_oriented
+class ReplayRenderer:
+    def __init__(self, sequence):
+        self.sequence = sequence
+        capacity = max(max(sequence.particle_num), 1)
+        self.position = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.color = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.particle_num = 0
+        self.frame_idx = -1
+        self.mesh_vertices = []
+        self.mesh_indices = []
+        for mesh in sequence.meshes.values():
+            vertices = ti.Vector.field(3, dtype=ti.f32, shape=len(mesh.vertices))
+            vertices.from_numpy(np.asarray(mesh.vertices, dtype=np.float32))
+            indices = ti.field(dtype=ti.i32, shape=mesh.faces.size)
+            indices.from_numpy(np.asarray(mesh.faces, dtype=np.int32).ravel())
+            self.mesh_vertices.append(vertices)
+            self.mesh_indices.append(indices)
+
+    @ti.kernel
+    def upload(self, position: ti.types.ndarray(), temperature: ti.types.ndarray(), particle_num: int):
+        for i in range(particle_num):
+            self.position[i] = ti.Vector([position[i, 0], position[i, 1], position[i, 2]])
+            self.color[i] = particle_system.temperature_to_color(temperature[i])
+
+    def show_frame(self, frame_idx):
+        # Only the frames actually displayed are read, frames skipped during fast playback cost nothing
+        if frame_idx == self.frame_idx:
+            return
+        position, temperature = self.sequence.read(frame_idx)
+        self.particle_num = position.shape[0]
+        if self.particle_num > 0:
+            self.upload(position, temperature, self.particle_num)
+        self.frame_idx = frame_idx
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Play back recorded frames without running the solver.')
+    parser.add_argument('directory', help='output directory of run_headless.py or run_simulation.py')
+    parser.add_argument('--scene', default=None, help='scene JSON, for the particle radius and the domain box')
+    parser.add_argument('--fps', type=float, default=30.0, help='recorded frames per second at speed 1')
+    parser.add_argument('--arch', default='gpu', choices=['cpu', 'gpu', 'cuda', 'vulkan'], help='Taichi backend')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ti.init(arch={'cpu': ti.cpu, 'gpu': ti.gpu, 'cuda': ti.cuda, 'vulkan': ti.vulkan}[args.arch])
+    sequence = FrameSequence(args.directory)
+    renderer = ReplayRenderer(sequence)
+    print('{} frames, up to {} particles, {} meshes'.format(
+        len(sequence), max(sequence.particle_num), len(sequence.meshes)))
+
+    particle_radius = 0.01
+    box_vertex_point = None
+    if args.scene is not None:
+        with open(args.scene, 'r') as f:
+            config = json.load(f)['Configuration']
+        particle_radius = config['particleRadius']
+        box_x, box_y, box_z = config['domainEnd']
+        box_vertex_point = ti.Vector.field(3, dtype=ti.f32, shape=8)
+        for i, corner in enumerate([[0., 0., 0.], [0., box_y, 0.], [box_x, 0., 0.], [box_x, box_y, 0.],
+                                    [0., 0., box_z], [0., box_y, box_z], [box_x, 0., box_z], [box_x, box_y, box_z]]):
+            box_vertex_point[i] = corner
+        box_edge_index = ti.field(dtype=ti.i32, shape=24)
+        for i, idx in enumerate([0, 1, 0, 2, 1, 3, 2, 3, 4, 5, 4, 6, 5, 7, 6, 7, 0, 4, 1, 5, 2, 6, 3, 7]):
+            box_edge_index[i] = idx
+
+    window = ti.ui.Window('SPH Replay', (1500, 1000))
+    canvas = window.get_canvas()
+    scene = ti.ui.Scene()
+    camera = ti.ui.Camera()
+    camera.position(6.5, 3.5, 5)
+    camera.lookat(-1, -1.5, -3)
+    canvas.set_background_color((0.1, 0.1, 0.1))
+    gui = window.get_gui()
+
+    # Playback position in frames. It advances with wall clock time, so a slow frame read skips frames instead of
+    # slowing playback down.
+    playhead = 0.0
+    playing = True
+    loop = True
+    speed = 1.0
+    last_time = time.perf_counter()
+    last_frame = len(sequence) - 1
+    while window.running:
+        now = time.perf_counter()
+        if playing:
+            playhead += speed * args.fps * (now - last_time)
+            if playhead > last_frame:
+                if loop:
+                    playhead %= len(sequence)
+                else:
+                    playhead = last_frame
+                    playing = False
+        last_time = now
+
+        for event in window.get_events(ti.ui.PRESS):
+            if event.key == ti.ui.SPACE:
+                playing = not playing
+            elif event.key == ti.ui.LEFT:
+                playhead = max(int(playhead) - 1, 0)
+            elif event.key == ti.ui.RIGHT:
+                playhead = min(int(playhead) + 1, last_frame)
+
+        gui.begin('Replay', 0, 0, 0.2, 0.3)
+        gui.text('Frame {} / {}, {} particles'.format(int(playhead), last_frame, renderer.particle_num))
+        scrubbed = gui.slider_int('Frame', int(playhead), 0, last_frame)
+        if scrubbed != int(playhead):
+            playhead = float(scrubbed)
+        speed = gui.slider_float('Speed', speed, 0.1, 8.0)
+        if gui.button('Pause' if playing else 'Play'):
+            playing = not playing
+        if gui.button('Restart'):
+            playhead = 0.0
+        loop = gui.checkbox('Loop', loop)
+        gui.text('Space: play/pause, Left/Right: step')
+        gui.end()
+
+        renderer.show_frame(int(playhead))
+        camera.track_user_inputs(window, movement_speed=0.02, hold_key=ti.ui.RMB)
+        scene.set_camera(camera)
+        scene.point_light((2, 2, 2), color=(1, 1, 1))
+        scene.ambient_light(color=(0.5, 0.5, 0.5))
+        if box_vertex_point is not None:
+            scene.lines(box_vertex_point, width=3.0, indices=box_edge_index, color=(0, 0, 0))
+        if renderer.particle_num > 0:
+            scene.particles(renderer.position, radius=particle_radius, per_vertex_color=renderer.color,
+                            index_count=renderer.particle_num)
+        for vertices, indices in zip(renderer.mesh_vertices, renderer.mesh_indices):
+            scene.mesh(vertices, indices, color=(0.2, 0.2, 0.2))
+        canvas.scene(scene)
+        window.show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#run_headless.py
+import argparse
+import json
+import os
+import time
+import taichi as ti
+import particle_system
+import exporter
+import checkpoint
+import profiler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a scene without a window, e.g. on the render farm.')
+    parser.add_argument('--scene', default='./data/scenes/volcano_eruption.json', help='scene JSON file')
+    parser.add_argument('--arch', default='gpu', choices=['cpu', 'gpu', 'cuda', 'vulkan'], help='Taichi backend')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads, all cores by default')
+    parser.add_argument('--frames', type=int, default=1000, help='number of frames to simulate')
+    parser.add_argument('--steps-per-frame', type=int, default=None,
+                        help='steps per frame, numberOfStepsPerRenderUpdate of the scene by default')
+    parser.add_argument('--cooling-rate', type=float, default=50.0,
+                        help='temperature drop of the lava per frame, as in run_simulation.py')
+    parser.add_argument('--output-dir', default=None, help='output directory, <scene name>_output by default')
+    parser.add_argument('--export', default='none', choices=['none'] + exporter.FrameExporter.FORMATS,
+                        help='per frame output of the fluid, see exporter.FrameExporter')
+    parser.add_argument('--compress', action='store_true', help='compress the exported frames')
+    parser.add_argument('--quantize', action='store_true', help='store positions as uint16, npz only')
+    parser.add_argument('--export-interval', type=int, default=None,
+                        help='frames between exports, outputInterval of the scene by default')
+    parser.add_argument('--checkpoint-interval', type=int, default=None,
+                        help='frames between checkpoints, checkpointInterval of the scene by default, 0 disables them')
+    parser.add_argument('--restart', default=None, metavar='CHECKPOINT',
+                        help='continue from a checkpoint file instead of setting up the scene')
+    parser.add_argument('--profile', default=None, metavar='JSONL',
+                        help='time every stage and append a summary line per frame to this file')
+    return parser.parse_args()
+
+
+def init_taichi(args):
+    arch = {'cpu': ti.cpu, 'gpu': ti.gpu, 'cuda': ti.cuda, 'vulkan': ti.vulkan}[args.arch]
+    if args.threads is not None:
+        ti.init(arch=arch, cpu_max_num_threads=args.threads)
+    else:
+        ti.init(arch=arch)
+
+
+def build_simulation(simulation_config):
+    ps = particle_system.ParticleSystem(simulation_config)
+    ps.memory_allocation_and_initialization_only_position()
+    ps.memory_allocation_and_initialization()
+    solver = ps.build_solver()
+    solver.initialize()
+    return ps, solver
+
+
+def simulate(ps, solver, frame_num, steps_per_frame, cooling_rate, on_frame=None):
+    """
+    Advance frame_num frames of steps_per_frame steps, calling on_frame(frame) after each. Returns the wall time
+    and the particle steps done, counting the particles a step works on: the active ones and the static rigid ones.
+    """
+    particle_steps = 0
+    ti.sync()
+    start_time = time.perf_counter()
+    for frame in range(frame_num):
+        particle_num = ps.active_particle_num[None] + ps.total_static_rigid_particle_num
+        solver.step_batch(steps_per_frame)
+        ps.cool_particles(cooling_rate)
+        particle_steps += particle_num * steps_per_frame
+        if on_frame is not None:
+            on_frame(frame)
+    ti.sync()
+    return {'start_time': start_time, 'elapsed': time.perf_counter() - start_time, 'particle_steps': particle_steps}
+
+
+def main():
+    args = parse_args()
+    init_taichi(args)
+
+    if args.restart is not None:
+        ps, solver, start_frame = checkpoint.load_checkpoint(args.restart)
+        simulation_config = ps.simulation_config
+        print('Restarted from {} at frame {}'.format(args.restart, start_frame))
+    else:
+        with open(args.scene, 'r') as f:
+            simulation_config = json.load(f)
+        ps, solver = build_simulation(simulation_config)
+        start_frame = 0
+    config = simulation_config['Configuration']
+    steps_per_frame = args.steps_per_frame or config['numberOfStepsPerRenderUpdate']
+    export_interval = args.export_interval or config.get('outputInterval', 1)
+    checkpoint_interval = args.checkpoint_interval if args.checkpoint_interval is not None \
+        else config.get('checkpointInterval', 0)
+    scene_name = os.path.splitext(os.path.basename(args.scene))[0]
+    output_dir = args.output_dir or f'{scene_name}_output'
+
+    print(ps.memory_usage_report())
+    frame_exporter = None
+    if args.export != 'none':
+        frame_exporter = exporter.FrameExporter(ps, output_dir, args.export, args.compress, args.quantize)
+    if checkpoint_interval > 0:
+        os.makedirs(output_dir, exist_ok=True)
+    kernel_profiler = None
+    if args.profile is not None:
+        kernel_profiler = profiler.Profiler()
+        kernel_profiler.attach(ps, solver)
+
+    def on_frame(frame):
+        frame += start_frame
+        if kernel_profiler is not None:
+            kernel_profiler.dump(args.profile, frame=frame)
+        if frame_exporter is not None and frame % export_interval == 0:
+            frame_exporter.export(frame // export_interval)
+        if checkpoint_interval > 0 and (frame + 1) % checkpoint_interval == 0:
+            # Saved after frame is done, a restart continues with frame + 1
+            checkpoint.save_checkpoint(os.path.join(output_dir, 'checkpoint_{:06}.ckpt'.format(frame + 1)),
+                                       ps, solver, frame + 1)
+
+    stats = simulate(ps, solver, args.frames, steps_per_frame, args.cooling_rate, on_frame)
+    if frame_exporter is not None:
+        # Wait for the writer, the last frames count towards the run time
+        frame_exporter.close()
+        stats['elapsed'] = time.perf_counter() - stats['start_time']
+
+    step_num = args.frames * steps_per_frame
+    print('{} frames, {} steps, {:.3f} s simulated in {:.2f} s'.format(
+        args.frames, step_num, solver.simulation_time[None], stats['elapsed']))
+    print('Throughput: {:.3e} particle steps/s, {:.1f} steps/s'.format(
+        stats['particle_steps'] / stats['elapsed'], step_num / stats['elapsed']))
+    if args.export != 'none':
+        print('Frames exported to {}'.format(output_dir))
+
+
+if __name__ == '__main__':
+    main()
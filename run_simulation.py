@@ -2,6 +2,8 @@
 import taichi as ti
 import json
 import particle_system
+import exporter
+import profiler
 import numpy as np
 import os
 from smoke import Smoke3D
@@ -15,12 +17,20 @@ with open('./data/scenes/volcano_eruption.json', 'r') as f:
 config = simulation_config['Configuration']
 
 box_x, box_y, box_z = config['domainEnd']
-# Define crater location (example: center of the simulation domain)
-crater_x, crater_y, crater_z = box_x / 2, box_y / 4, box_z / 2
 
-# Initialize Smoke
+# The lava cools by cooling_rate degrees per frame once the simulation runs
+cooling_rate = 50
+
+# Initialize Smoke. It rises from lava hotter than the threshold at the free surface, sampled on the device with at
+# most smoke_budget new puffs per frame. Before Start and with no such lava left it rises from the crater.
 max_height = box_y - 0.1
-smoke = Smoke3D(crater_x, crater_y - 0.3, crater_z, max_height)
+crater_x, crater_y, crater_z = config.get('craterPosition', [0.85, 0.15, 0.85])
+smoke = Smoke3D(crater_x, crater_y, crater_z, max_height, spawn_num=0)
+# Fresh 1200 degree lava stays above 400 degrees for 15 frames at the cooling rate above
+smoke_temperature_threshold = config.get('smokeTemperatureThreshold', 400.0)
+# Free surface: the mean neighbor position is this many particle radii off the particle
+smoke_surface_offset = config.get('smokeSurfaceOffset', 0.5) * config['particleRadius']
+smoke_budget = config.get('smokeEmissionBudget', 20)
 
 
 box_vertex_point = ti.Vector.field(3, dtype=ti.f32, shape=8)
@@ -71,7 +81,10 @@ output_interval = config['outputInterval']
 output_ply = False
 cnt = 0
 cnt_ply = 0
-series_prefix = "{}_output/particle_object_{}.ply".format(scene_name, "{}")
+frame_exporter = None
+# Per-stage timings, see profiler.Profiler. Only costs time while enabled in the panel.
+kernel_profiler = profiler.Profiler()
+profile_file = f"{scene_name}_profile.jsonl"
 enter_second_phase_first_time = True
 reset_scene_flag = False
 
@@ -82,10 +95,8 @@ index_field = ti.field(ti.i32, shape=(max_particles * 6))
 
 while window.running:
     if start_step:
-        for i in range(substep):
-            solver.step()
-    cooling_rate = 50
-    ps.cool_particles(cooling_rate)
+        solver.step_batch(substep)
+        ps.cool_particles(cooling_rate)
     #ps.update_fluid_colors()
     camera.track_user_inputs(window, movement_speed=0.02, hold_key=ti.ui.RMB)
 
@@ -111,10 +122,12 @@ while window.running:
     up = np.cross(right, forward)
     up /= np.linalg.norm(up)
     # Update Smoke Particles
+    if start_step:
+        smoke.emit_from_particles(ps, smoke_temperature_threshold, smoke_surface_offset, smoke_budget)
+    else:
+        smoke.emit_at_origin(smoke_budget)
     smoke.update()
 
-    smoke.draw(pos_field, color_field, index_field, max_particles, right, up)
-
     # Draw smoke as a mesh instead of particles
     count = smoke.draw(pos_field, color_field, index_field, max_particles, right, up)
     scene.mesh(pos_field, indices=index_field, per_vertex_color=color_field,
@@ -127,6 +140,7 @@ while window.running:
         if gui.button('Start'):
             start_step = True
             ps.memory_allocation_and_initialization()
+            print(ps.memory_usage_report())
             solver = ps.build_solver()
             solver.initialize()
             draw_object_in_mesh = True
@@ -199,11 +213,12 @@ while window.running:
 
         gui.text('----------------------------')
         output_frames = gui.checkbox('Output in Image', output_frames)
-        output_ply = gui.checkbox('Output [.ply] files', output_ply)
+        output_ply = gui.checkbox('Output particle frames', output_ply)
         gui.end()
     else:
         if gui.button('Reset Scene'):
             ps.reset_particle_system()
+            solver.initialize()
             reset_scene_flag = True
         if gui.button('Reset View'):
             camera.position(6.5, 3.5, 5)
@@ -211,18 +226,28 @@ while window.running:
         draw_object_in_mesh = gui.checkbox('Draw object in mesh', draw_object_in_mesh)
         gui.text('----------------------------')
         gui.text('Euler step time interval')
-        solver.dt[None] = gui.slider_float('[10^-3]', solver.dt[None] * 1000, 0.2, 0.8) * 0.001
+        if solver.adaptive_time_step:
+            # Picked by the solver every step from the CFL and force conditions, capped for high viscosity and
+            # surface tension as below, see WCSPHSolver.stable_time_step_bound
+            gui.text('{:.4f} [10^-3]'.format(solver.dt[None] * 1000))
+        else:
+            solver.dt[None] = gui.slider_float('[10^-3]', solver.dt[None] * 1000, 0.2, 0.8) * 0.001
+        gui.text('Simulation time')
+        gui.text('{:.3f} [s]'.format(solver.simulation_time[None]))
         gui.text('Viscosity')
         solver.viscosity[None] = gui.slider_float('', solver.viscosity[None], 0.001, 0.5)
         gui.text('Surface Tension')
         solver.surface_tension[None] = gui.slider_float('[N/m]', solver.surface_tension[None], 0.001, 5)
-        if solver.viscosity[None] > 0.23 or solver.surface_tension[None] > 2.0:
-            # Viscosity with over 0.23 cause numerical instability when time step is larger than 0.0005 typically.
-            # Surface tension with over 2.0 cause numerical instability when time step is larger than 0.0005 typically.
-            solver.dt[None] = ti.min(solver.dt[None], 0.0005)
-        if solver.viscosity[None] > 0.23 and solver.surface_tension[None] > 2.0:
-            # Both in high viscosity and high surface tension, for numerical stability it is recommend to set 0.0004
-            solver.dt[None] = ti.min(solver.dt[None], 0.0004)
+        if not solver.adaptive_time_step:
+            if solver.viscosity[None] > 0.23 or solver.surface_tension[None] > 2.0:
+                # Viscosity with over 0.23 cause numerical instability when time step is larger than 0.0005 typically.
+                # Surface tension with over 2.0 cause numerical instability when time step is larger than 0.0005
+                # typically.
+                solver.dt[None] = ti.min(solver.dt[None], 0.0005)
+            if solver.viscosity[None] > 0.23 and solver.surface_tension[None] > 2.0:
+                # Both in high viscosity and high surface tension, for numerical stability it is recommend to set
+                # 0.0004
+                solver.dt[None] = ti.min(solver.dt[None], 0.0004)
         gui.text('----------------------------')
         gui.text('# of Fluid Particles')
         gui.text('{}'.format(ps.total_fluid_particle_num))
@@ -230,6 +255,24 @@ while window.running:
         gui.text('{}'.format(ps.total_rigid_particle_num))
         gui.text('Total # of Particles')
         gui.text('{}'.format(ps.total_particle_num))
+        if ps.use_emitter:
+            gui.text('# of Emitted Lava Particles')
+            gui.text('{}'.format(solver.emitter.emitted_num[None]))
+        if ps.use_particle_deletion:
+            gui.text('# of Deleted Particles')
+            gui.text('{}'.format(ps.deleted_particle_num[None]))
+        gui.text('----------------------------')
+        profile_kernels = gui.checkbox('Profile kernels', kernel_profiler.attached)
+        if profile_kernels != kernel_profiler.attached:
+            if profile_kernels:
+                kernel_profiler.attach(ps, solver)
+            else:
+                kernel_profiler.detach()
+        if kernel_profiler.attached:
+            for line in kernel_profiler.summary_lines():
+                gui.text(line)
+            if gui.button('Dump profile'):
+                kernel_profiler.dump(profile_file, frame=cnt)
         gui.end()
 
     scene.set_camera(camera)
@@ -247,11 +290,21 @@ while window.running:
         #    ps.fluid_only_color[i] = [1.0, 0.5, 0.0, 1.0]  # RGBA: Red-orange lava
         ps.update_fluid_position_info()
         ps.update_fluid_color_info()
-        scene.particles(ps.fluid_only_position, radius=ps.particle_radius, per_vertex_color=ps.fluid_only_color)
+        scene.particles(ps.fluid_only_position, radius=ps.particle_radius, per_vertex_color=ps.fluid_only_color,
+                        index_count=ps.tmp_cnt[None])
         for i in range(len(ps.mesh_vertices)):
             scene.mesh(ps.mesh_vertices[i], ps.mesh_indices[i], color=(0.2, 0.2, 0.2))
     else:
-        scene.particles(ps.position, radius=ps.particle_radius, per_vertex_color=ps.color)
+        # Active particles and static rigid particles, the free emitter slots in between are not drawn
+        scene.particles(ps.position, radius=ps.particle_radius, per_vertex_color=ps.color,
+                        index_count=ps.active_particle_num[None])
+        if ps.total_static_rigid_particle_num > 0:
+            scene.particles(ps.position, radius=ps.particle_radius, per_vertex_color=ps.color,
+                            index_offset=ps.dynamic_particle_num, index_count=ps.total_static_rigid_particle_num)
+        for i in range(len(ps.rigidBodiesConfig)):
+            if ps.is_density_map_body(ps.rigidBodiesConfig[i]):
+                # Density map bodies have no particles to show
+                scene.mesh(ps.mesh_vertices[i], ps.mesh_indices[i], color=(0.2, 0.2, 0.2))
     canvas.scene(scene)
     if start_step:
         if reset_scene_flag:
@@ -261,23 +314,18 @@ while window.running:
         if enter_second_phase_first_time:
             if output_frames:
                 os.makedirs(f"{scene_name}_output_img", exist_ok=True)  # output image
-            if output_ply:
-                os.makedirs(f"{scene_name}_output", exist_ok=True)
             enter_second_phase_first_time = False
 
         if cnt % output_interval == 0:
             if output_ply:
-                ps.update_fluid_position_info()
-                np_position = ps.dump()
-                writer = ti.tools.PLYWriter(num_vertices=ps.total_fluid_particle_num)
-                writer.add_vertex_pos(np_position[:, 0], np_position[:, 1], np_position[:, 2])
-                writer.export_frame_ascii(cnt_ply, series_prefix.format(0))
-                for r_body_id in ps.rigid_object_id:
-                    with open(f"{scene_name}_output/obj_{r_body_id}_{cnt_ply:06}.obj", "w") as f:
-                        e = ps.object_collection[r_body_id]["mesh"].export(file_type='obj')
-                        f.write(e)
+                if frame_exporter is None:
+                    frame_exporter = exporter.FrameExporter(ps, f"{scene_name}_output")
+                frame_exporter.export(cnt_ply)
                 cnt_ply += 1
             if output_frames:
                 window.save_image(f"{scene_name}_output_img/{cnt:06}.png")
         cnt += 1
     window.show()
+
+if frame_exporter is not None:
+    frame_exporter.close()
@@ -0,0 +1,178 @@
+#run_sweep.py
+import argparse
+import copy
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+import numpy as np
+
+METRICS = ['status', 'elapsed', 'steps', 'simulation_time', 'particle_steps_per_second', 'final_dt', 'fluid_num',
+           'emitted_num', 'deleted_num', 'mean_density', 'max_density_error', 'max_velocity', 'mean_fluid_height',
+           'error']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run every combination of parameter values on a base scene in a pool of worker processes.')
+    parser.add_argument('--scene', default='./data/scenes/volcano_eruption.json', help='base scene JSON file')
+    parser.add_argument('--param', action='append', default=[], metavar='KEY=JSON_LIST',
+                        help='values of one parameter, e.g. viscosity=[0.05,0.1]. KEY is a Configuration key or '
+                             'a dotted path into the scene such as Emitter.rate or RigidBodies.0.sigma')
+    parser.add_argument('--grid', default=None, help='JSON file mapping keys to lists of values, same keys as --param')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, cores / threads by default')
+    parser.add_argument('--threads', type=int, default=1, help='CPU threads of every worker')
+    parser.add_argument('--arch', default='cpu', choices=['cpu', 'gpu', 'cuda', 'vulkan'], help='Taichi backend')
+    parser.add_argument('--frames', type=int, default=200, help='frames per run')
+    parser.add_argument('--steps-per-frame', type=int, default=None,
+                        help='steps per frame, numberOfStepsPerRenderUpdate of the scene by default')
+    parser.add_argument('--cooling-rate', type=float, default=50.0, help='temperature drop of the lava per frame')
+    parser.add_argument('--output', default='sweep_results.csv', help='results table (CSV)')
+    return parser.parse_args()
+
+
+def parse_grid(args):
+    grid = {}
+    if args.grid is not None:
+        with open(args.grid, 'r') as f:
+            grid.update(json.load(f))
+    for param in args.param:
+        key, values = param.split('=', 1)
+        grid[key.strip()] = json.loads(values)
+    for key, values in grid.items():
+        if not isinstance(values, list) or len(values) == 0:
+            raise ValueError('Values of {} have to be a non-empty list, got {}'.format(key, values))
+    return grid
+
+
+def set_parameter(simulation_config, key, value):
+    path = key.split('.') if '.' in key else ['Configuration', key]
+    node = simulation_config
+    for name in path[:-1]:
+        node = node[int(name)] if isinstance(node, list) else node.setdefault(name, {})
+    if isinstance(node, list):
+        node[int(path[-1])] = value
+    else:
+        node[path[-1]] = value
+
+
+def summarize(ps, solver, stats, step_num):
+    active_num = ps.active_particle_num[None]
+    fluid = ps.material.to_numpy()[:active_num] == ps.material_fluid
+    density = ps.density.to_numpy()[:active_num][fluid]
+    speed = np.linalg.norm(ps.velocity.to_numpy()[:active_num][fluid], axis=1)
+    height = ps.position.to_numpy()[:active_num][fluid][:, 1]
+    fluid_num = int(fluid.sum())
+    finite = bool(np.isfinite(density).all() and np.isfinite(speed).all() and np.isfinite(height).all())
+    return {
+        'status': 'ok' if finite else 'diverged',
+        'elapsed': stats['elapsed'],
+        'steps': step_num,
+        'simulation_time': solver.simulation_time[None],
+        'particle_steps_per_second': stats['particle_steps'] / stats['elapsed'],
+        'final_dt': solver.dt[None],
+        'fluid_num': fluid_num,
+        'emitted_num': solver.emitter.emitted_num[None] if ps.use_emitter else 0,
+        'deleted_num': ps.deleted_particle_num[None] if ps.use_particle_deletion else 0,
+        'mean_density': float(density.mean()) if fluid_num else 0.0,
+        'max_density_error': float(np.abs(density / ps.density0 - 1.0).max()) if fluid_num else 0.0,
+        'max_velocity': float(speed.max()) if fluid_num else 0.0,
+        'mean_fluid_height': float(height.mean()) if fluid_num else 0.0,
+    }
+
+
+def run_configuration(task):
+    """
+    Worker entry point. Every task runs in a fresh process (maxtasksperchild=1), so it gets its own Taichi runtime
+    with its own thread budget.
+    """
+    run_idx, params, simulation_config, arch, threads, frame_num, steps_per_frame, cooling_rate = task
+    try:
+        import taichi as ti
+        import run_headless
+        arch = {'cpu': ti.cpu, 'gpu': ti.gpu, 'cuda': ti.cuda, 'vulkan': ti.vulkan}[arch]
+        ti.init(arch=arch, cpu_max_num_threads=threads, log_level=ti.WARN)
+        ps, solver = run_headless.build_simulation(simulation_config)
+        stats = run_headless.simulate(ps, solver, frame_num, steps_per_frame, cooling_rate)
+        result = summarize(ps, solver, stats, frame_num * steps_per_frame)
+    except Exception:
+        result = {'status': 'failed', 'error': traceback.format_exc().strip().splitlines()[-1]}
+    return run_idx, params, result
+
+
+def fill_voxel_cache(tasks):
+    """
+    Voxelize the rigid bodies of every distinct setup once in the parent, with every CPU, so the runs load them from
+    the voxel cache instead of all voxelizing the same meshes at once.
+    """
+    setups = dict()
+    for task in tasks:
+        simulation_config = task[2]
+        cache_directory = simulation_config['Configuration'].get('voxelCacheDirectory', './data/voxel_cache')
+        if not cache_directory:
+            continue
+        key = json.dumps([cache_directory, simulation_config['Configuration']['particleRadius'],
+                          simulation_config['RigidBodies']], sort_keys=True)
+        setups.setdefault(key, simulation_config)
+    if not setups:
+        return
+    import taichi as ti
+    import particle_system
+    ti.init(arch=ti.cpu, log_level=ti.WARN)
+    for simulation_config in setups.values():
+        simulation_config = copy.deepcopy(simulation_config)
+        simulation_config['Configuration']['voxelizerWorkers'] = None
+        try:
+            # Loads and voxelizes the rigid bodies
+            particle_system.ParticleSystem(simulation_config).memory_allocation_and_initialization_only_position()
+        except Exception:
+            # The runs of this setup report the error themselves
+            print('Could not fill the voxel cache: ' + traceback.format_exc().strip().splitlines()[-1])
+
+
+def main():
+    args = parse_args()
+    with open(args.scene, 'r') as f:
+        base_config = json.load(f)
+    grid = parse_grid(args)
+    steps_per_frame = args.steps_per_frame or base_config['Configuration']['numberOfStepsPerRenderUpdate']
+    workers = args.workers or max((os.cpu_count() or 1) // args.threads, 1)
+
+    keys = list(grid.keys())
+    tasks = []
+    for run_idx, values in enumerate(itertools.product(*(grid[key] for key in keys))):
+        params = dict(zip(keys, values))
+        simulation_config = copy.deepcopy(base_config)
+        # Pool workers are daemonic and cannot fork, the parallel voxelizer gets the thread budget of the run instead
+        simulation_config['Configuration']['voxelizerWorkers'] = args.threads
+        for key, value in params.items():
+            set_parameter(simulation_config, key, value)
+        tasks.append((run_idx, params, simulation_config, args.arch, args.threads, args.frames, steps_per_frame,
+                      args.cooling_rate))
+    print('{} runs on {} workers with {} threads each'.format(len(tasks), workers, args.threads))
+    fill_voxel_cache(tasks)
+
+    # spawn, since a forked child would inherit the state of the parent's Taichi and threading libraries
+    results = [None] * len(tasks)
+    start_time = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(workers, maxtasksperchild=1) as pool:
+        for run_idx, params, result in pool.imap_unordered(run_configuration, tasks):
+            results[run_idx] = (params, result)
+            print('[{}/{}] {} {}'.format(sum(r is not None for r in results), len(tasks), params,
+                                         result.get('error') or result['status']))
+    print('Sweep finished in {:.1f} s'.format(time.perf_counter() - start_time))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run'] + keys + METRICS)
+        for run_idx, (params, result) in enumerate(results):
+            writer.writerow([run_idx] + [json.dumps(params[key]) for key in keys] +
+                            [result.get(metric, '') for metric in METRICS])
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
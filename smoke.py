@@ -1,95 +1,206 @@
-import random
-import numpy as np
-
-class SmokeParticle3D:
-    def __init__(self, x=0, y=0, z=0, max_height=1.0):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.size = 0.05   # Slightly larger to see better
-        self.alpha = 1.0
-        self.alpha_rate = 0.01
-        self.vx = random.uniform(-0.005, 0.005)
-        self.vy = 0.01 + random.random() * 0.01
-        self.vz = random.uniform(-0.005, 0.005)
-        self.max_height = max_height
+import taichi as ti
+from particle_system import make_prefix_sum_executor
 
-    def update(self):
-        # Move the particle
-        self.x += self.vx
-        self.y += self.vy
-        self.z += self.vz
-
-        # If it reaches the max height, stop ascending
-        if self.y > self.max_height:
-            self.y = self.max_height
-            self.vy = 0.0
-            # Optionally reduce alpha decay to slow or stop fading
-            self.alpha_rate = 0.005  # Fade slower at the top
-
-        # Update alpha
-        self.alpha -= self.alpha_rate
-        if self.alpha < 0:
-            self.alpha = 0
+# Billboard corners in units of (right, up), in the order of the two triangles (0, 1, 2) and (0, 2, 3)
+QUAD_CORNERS = ((-1.0, -1.0), (1.0, -1.0), (1.0, 1.0), (-1.0, 1.0))
+QUAD_INDICES = (0, 1, 2, 0, 2, 3)
 
+
+@ti.data_oriented
 class Smoke3D:
-    def __init__(self, x=0, y=0, z=0, max_height=1.0):
-        self.x = x
-        self.y = y
-        self.z = z
-        self.particles = []
+    """
+    Smoke puffs rising from (x, y, z) or from hot lava, stored in Taichi fields used as a ring buffer of 'capacity'
+    slots. Slots are taken in spawn order, so walking the ring from head visits the particles from oldest to newest.
+    Particles that faded out stay in their slot until head passes them. Once the ring is full, new particles replace
+    the oldest. update spawns spawn_num particles at (x, y, z) and emit_at_origin any number, emit_from_particles
+    spawns at hot fluid particles on the free surface of a particle system.
+    update, emit_from_particles and draw run as kernels, the only data leaving the device per frame is the number of
+    quads to draw.
+    draw numbers the visible particles in ring order with a prefix sum, so the oldest max_particles of them are drawn.
+    """
+    def __init__(self, x=0, y=0, z=0, max_height=1.0, capacity=8192, spawn_num=20):
+        self.origin = ti.Vector([x, y, z])
         self.max_height = max_height
+        self.capacity = capacity
+        self.spawn_num = spawn_num
+        self.size = 0.05   # Slightly larger to see better
+
+        self.position = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.velocity = ti.Vector.field(3, dtype=ti.f32, shape=capacity)
+        self.alpha = ti.field(dtype=ti.f32, shape=capacity)
+        self.alpha_rate = ti.field(dtype=ti.f32, shape=capacity)
+        self.head = ti.field(dtype=ti.i32, shape=())
+        self.used = ti.field(dtype=ti.i32, shape=())  # slots from head on that hold a particle, faded or not
+        self.candidate_num = ti.field(dtype=ti.i32, shape=())
+        self.emitted = ti.field(dtype=ti.i32, shape=())
+        self.draw_order = ti.field(dtype=ti.i32, shape=capacity)
+        self.draw_order_prefix_sum = make_prefix_sum_executor(capacity)
+        self.index_field = None
+        self.ps = None
+
+    @ti.func
+    def reserve(self, spawn_num):
+        """
+        Make room for spawn_num particles after the newest one and return the first of their slots. used is not
+        increased, the caller adds the particles it actually spawned.
+        """
+        # Release the faded particles at the old end of the ring
+        while self.used[None] > 0 and self.alpha[self.head[None]] <= 0.0:
+            self.head[None] = (self.head[None] + 1) % self.capacity
+            self.used[None] -= 1
+        overflow = self.used[None] + spawn_num - self.capacity
+        if overflow > 0:
+            self.head[None] = (self.head[None] + overflow) % self.capacity
+            self.used[None] -= overflow
+        return self.head[None] + self.used[None]
+
+    @ti.func
+    def spawn(self, slot, position):
+        self.position[slot] = position
+        self.velocity[slot] = ti.Vector([ti.random() * 0.01 - 0.005, 0.01 + ti.random() * 0.01,
+                                         ti.random() * 0.01 - 0.005])
+        self.alpha[slot] = 1.0
+        self.alpha_rate[slot] = 0.01
+
+    @ti.func
+    def neighbor_offset_task(self, p_i, p_j, offset: ti.template()):
+        r = self.ps.position[p_j] - self.ps.position[p_i]
+        offset += ti.Vector([r[0], r[1], r[2], 1.0])
+
+    @ti.func
+    def is_emission_site(self, i, temperature_threshold, surface_offset):
+        site = False
+        if self.ps.material[i] == self.ps.material_fluid and self.ps.temperature[i] > temperature_threshold:
+            # Inside the fluid the neighbors surround the particle evenly. Near the free surface one side is empty and
+            # the mean of the neighbor positions moves away from it.
+            # The grid holds every particle as of the last sort, while a neighbor list row can be missing for a
+            # particle added or moved since. Particles drift less than half the list skin in between.
+            offset = ti.Vector([0.0, 0.0, 0.0, 0.0])
+            self.ps.for_all_neighbors_in_grid(i, self.neighbor_offset_task, offset)
+            site = offset[3] == 0.0 or ti.Vector([offset[0], offset[1], offset[2]]).norm() > surface_offset * offset[3]
+        return site
+
+    @ti.kernel
+    def emit(self, temperature_threshold: ti.f32, surface_offset: ti.f32, budget: int, fallback_to_origin: int):
+        self.candidate_num[None] = 0
+        for i in range(self.ps.active_particle_num[None]):
+            if self.is_emission_site(i, temperature_threshold, surface_offset):
+                self.candidate_num[None] += 1
+        spawn_num = ti.min(budget, self.candidate_num[None])
+        fallback_num = 0
+        if self.candidate_num[None] == 0 and fallback_to_origin:
+            fallback_num = budget
+        spawn_begin = self.reserve(spawn_num + fallback_num)
 
+        # No hot surface left, the smoke keeps rising from the origin
+        for k in range(fallback_num):
+            self.spawn((spawn_begin + k) % self.capacity, self.origin)
+        self.used[None] += fallback_num
+
+        self.emitted[None] = 0
+        acceptance = ti.cast(spawn_num, ti.f32) / ti.max(self.candidate_num[None], 1)
+        for i in range(self.ps.active_particle_num[None]):
+            # Draw first, so only the taken fraction pays for the neighbor search again
+            if ti.random() < acceptance:
+                if self.is_emission_site(i, temperature_threshold, surface_offset):
+                    k = ti.atomic_add(self.emitted[None], 1)
+                    if k < spawn_num:
+                        self.spawn((spawn_begin + k) % self.capacity, self.ps.position[i])
+        # Chance may accept fewer sites than reserved, never more
+        self.used[None] += ti.min(self.emitted[None], spawn_num)
+
+    def emit_from_particles(self, ps, temperature_threshold, surface_offset, budget, fallback_to_origin=True):
+        """
+        Spawn up to budget particles at fluid particles of ps hotter than temperature_threshold on the free surface,
+        where the mean position of the neighbors is more than surface_offset away. Every such site is taken with the
+        same probability, budget over the number of sites. Without any site, budget particles are spawned at (x, y, z)
+        instead if fallback_to_origin is set. Runs on the device after a solver step, with the neighbor search of the
+        step.
+        """
+        if self.ps is None:
+            self.ps = ps
+        elif self.ps is not ps:
+            # emit is compiled against the fields of the first particle system
+            raise ValueError('Smoke3D can only emit from one particle system')
+        self.emit(temperature_threshold, surface_offset, budget, fallback_to_origin)
+
+    @ti.kernel
+    def emit_at_origin(self, spawn_num: int):
+        spawn_begin = self.reserve(spawn_num)
+        self.used[None] += spawn_num
+        for k in range(spawn_num):
+            self.spawn((spawn_begin + k) % self.capacity, self.origin)
+
+    @ti.kernel
     def update(self):
-        # Remove dead particles
-        self.particles = [p for p in self.particles if p.alpha > 0]
         # Generate new particles
-        for _ in range(20):
-            self.particles.append(SmokeParticle3D(self.x, self.y, self.z, self.max_height))
-        # Update all particles
-        for p in self.particles:
-            p.update()
+        spawn_begin = self.reserve(self.spawn_num)
+        self.used[None] += self.spawn_num
+        for k in range(self.spawn_num):
+            self.spawn((spawn_begin + k) % self.capacity, self.origin)
 
-    def draw(self, pos_field, color_field, index_field, max_particles, right, up):
-        count = len(self.particles)
-        count = min(count, max_particles)
+        for k in range(self.used[None]):
+            slot = (self.head[None] + k) % self.capacity
+            if self.alpha[slot] > 0.0:
+                # Move the particle
+                self.position[slot] += self.velocity[slot]
+                # If it reaches the max height, stop ascending and fade slower at the top
+                if self.position[slot][1] > self.max_height:
+                    self.position[slot][1] = self.max_height
+                    self.velocity[slot][1] = 0.0
+                    self.alpha_rate[slot] = 0.005
+                self.alpha[slot] = ti.max(self.alpha[slot] - self.alpha_rate[slot], 0.0)
 
-        # Create arrays sized for max_particles
-        pos_np = np.zeros((max_particles * 4, 3), dtype=np.float32)
-        color_np = np.zeros((max_particles * 4, 4), dtype=np.float32)
-        indices_np = np.zeros((max_particles * 6,), dtype=np.int32)  # full size
+    @ti.kernel
+    def mark_visible(self):
+        for k in range(self.capacity):
+            visible = 0
+            if k < self.used[None]:
+                if self.alpha[(self.head[None] + k) % self.capacity] > 0.0:
+                    visible = 1
+            self.draw_order[k] = visible
 
-        for i, p in enumerate(self.particles[:count]):
-            quad = compute_billboarded_quad(p.x, p.y, p.z, p.size, right, up)
-            base = i * 4
-            for v_idx, vpos in enumerate(quad):
-                pos_np[base + v_idx] = vpos
-                color_np[base + v_idx] = [1.0, 1.0, 1.0, p.alpha]
+    @ti.kernel
+    def visible_num(self) -> ti.i32:
+        num = 0
+        if self.used[None] > 0:
+            num = self.draw_order[self.used[None] - 1]
+        return num
 
-            tri_base = i * 6
-            indices_np[tri_base:tri_base+6] = [base, base+1, base+2, base, base+2, base+3]
+    @ti.kernel
+    def build_quads(self, pos_field: ti.template(), color_field: ti.template(), max_particles: int,
+                    right: ti.types.vector(3, ti.f32), up: ti.types.vector(3, ti.f32)):
+        for k in range(self.used[None]):
+            slot = (self.head[None] + k) % self.capacity
+            # draw_order is the inclusive prefix sum of the visible flags, minus one it is the quad index
+            q = self.draw_order[k] - 1
+            if self.alpha[slot] > 0.0 and q < max_particles:
+                for c in ti.static(range(4)):
+                    offset = (QUAD_CORNERS[c][0] * right + QUAD_CORNERS[c][1] * up) * self.size
+                    pos_field[q * 4 + c] = self.position[slot] + offset
+                    color_field[q * 4 + c] = ti.Vector([1.0, 1.0, 1.0, self.alpha[slot]])
 
-        pos_field.from_numpy(pos_np)
-        color_field.from_numpy(color_np)
-        index_field.from_numpy(indices_np)
-
-        # Return the count so that the caller knows how many to draw
-        return count
+    @ti.kernel
+    def build_indices(self, index_field: ti.template()):
+        for i in index_field:
+            index_field[i] = i // 6 * 4 + ti.Vector(QUAD_INDICES)[i % 6]
 
+    def particle_num(self):
+        self.mark_visible()
+        self.draw_order_prefix_sum.run(self.draw_order)
+        return self.visible_num()
 
+    def draw(self, pos_field, color_field, index_field, max_particles, right, up):
+        """
+        Billboards of the oldest max_particles visible particles into the fields, returns how many were written.
+        """
+        # The index pattern never changes, only index_count decides how much of it is drawn
+        if self.index_field is not index_field:
+            self.build_indices(index_field)
+            self.index_field = index_field
+        count = min(self.particle_num(), max_particles)
+        self.build_quads(pos_field, color_field, max_particles, ti.Vector(right, dt=ti.f32),
+                         ti.Vector(up, dt=ti.f32))
 
-def compute_billboarded_quad(x, y, z, size, right, up):
-    half = size
-    v0 = [x - right[0]*half - up[0]*half,
-          y - right[1]*half - up[1]*half,
-          z - right[2]*half - up[2]*half]
-    v1 = [x + right[0]*half - up[0]*half,
-          y + right[1]*half - up[1]*half,
-          z + right[2]*half - up[2]*half]
-    v2 = [x + right[0]*half + up[0]*half,
-          y + right[1]*half + up[1]*half,
-          z + right[2]*half + up[2]*half]
-    v3 = [x - right[0]*half + up[0]*half,
-          y - right[1]*half + up[1]*half,
-          z - right[2]*half + up[2]*half]
-    return [v0, v1, v2, v3]
+        # Return the count so that the caller knows how many to draw
+        return count
@@ -0,0 +1,80 @@
+#space_filling_curve.py
+import numpy as np
+
+
+def required_bits(grid_num):
+    return max(int(np.ceil(np.log2(max(int(np.max(grid_num)), 2)))), 1)
+
+
+def morton_code(grid_idx, bits):
+    """
+    Z-order index of integer cell coordinates by interleaving their bits.
+    grid_idx: (N, dim) array of non-negative cell coordinates below 2 ** bits.
+    """
+    grid_idx = np.asarray(grid_idx, dtype=np.int64)
+    dim = grid_idx.shape[1]
+    code = np.zeros(grid_idx.shape[0], dtype=np.int64)
+    for b in range(bits):
+        for d in range(dim):
+            code |= ((grid_idx[:, d] >> b) & 1) << (b * dim + dim - 1 - d)
+    return code
+
+
+def hilbert_code(grid_idx, bits):
+    """
+    Hilbert curve index of integer cell coordinates.
+    Programming the Hilbert curve, John Skilling 2004    (AxestoTranspose, then bit interleaving)
+    grid_idx: (N, dim) array of non-negative cell coordinates below 2 ** bits.
+    """
+    x = np.asarray(grid_idx, dtype=np.int64).T.copy()
+    dim = x.shape[0]
+    m = 1 << (bits - 1)
+
+    # Inverse undo
+    q = m
+    while q > 1:
+        p = q - 1
+        for i in range(dim):
+            bit_set = (x[i] & q) != 0
+            x[0] = np.where(bit_set, x[0] ^ p, x[0])  # invert
+            t = np.where(bit_set, 0, (x[0] ^ x[i]) & p)  # exchange
+            x[0] ^= t
+            x[i] ^= t
+        q >>= 1
+
+    # Gray encode
+    for i in range(1, dim):
+        x[i] ^= x[i - 1]
+    t = np.zeros_like(x[0])
+    q = m
+    while q > 1:
+        t = np.where((x[dim - 1] & q) != 0, t ^ (q - 1), t)
+        q >>= 1
+    for i in range(dim):
+        x[i] ^= t
+
+    # Transposed form to a single index, the top bit of x[0] is the most significant one.
+    code = np.zeros(x.shape[1], dtype=np.int64)
+    for b in range(bits):
+        for d in range(dim):
+            code |= ((x[d] >> b) & 1) << (b * dim + dim - 1 - d)
+    return code
+
+
+def cell_order_table(grid_num, ordering):
+    """
+    Rank of every cell along the chosen curve, indexed by the row-major flattened cell index.
+    Cells of a box that is not a power of two in size are ranked by their position on the enclosing curve.
+    """
+    grid_idx = np.stack(np.meshgrid(*[np.arange(n) for n in grid_num], indexing='ij'), axis=-1)
+    grid_idx = grid_idx.reshape(-1, len(grid_num))
+    bits = required_bits(grid_num)
+    if ordering == 'morton':
+        code = morton_code(grid_idx, bits)
+    elif ordering == 'hilbert':
+        code = hilbert_code(grid_idx, bits)
+    else:
+        raise ValueError('Unknown cellOrdering: {}'.format(ordering))
+    rank = np.empty(code.shape[0], dtype=np.int32)
+    rank[np.argsort(code, kind='stable')] = np.arange(code.shape[0], dtype=np.int32)
+    return rank
@@ -1,6 +1,8 @@
 #sph_base.py
 import taichi as ti
 import numpy as np
+import time
+import density_map
 
 
 @ti.data_oriented
@@ -10,14 +12,129 @@ class SPHBase:
         self.g = np.array(self.ps.config['gravitation'])
         self.dt = ti.field(ti.f32, shape=())
         self.dt[None] = self.ps.config['dt']
+        self.simulation_time = ti.field(ti.f32, shape=())
+        self.simulation_time[None] = 0.0
         self.collision_factor = self.ps.config['collisionFactor']
         self.viscosity = ti.field(ti.f32, shape=())
         self.viscosity[None] = self.ps.config['viscosity']
         self.c_s = self.ps.config['c_s']  # speed of the numerical propagation
         # [Versatile Rigid-Fluid Coupling for Incompressible SPH], between (11) and (12)
 
+        # W(r) and dW/dr sampled at kernelTableSize + 1 points over [0, support_length] and linearly interpolated.
+        # 0 evaluates the analytic kernel. kernel_table_check.py reports accuracy and speed of a table size.
+        self.kernel_table_size = self.ps.config.get('kernelTableSize', 0)
+        self.use_kernel_table = self.kernel_table_size > 0
+        if self.use_kernel_table:
+            self.kernel_table = ti.field(ti.f32, shape=self.kernel_table_size + 1)
+            self.kernel_derivative_table = ti.field(ti.f32, shape=self.kernel_table_size + 1)
+            self.build_kernel_table()
+
+        # Adaptive time step, see update_time_step. dt then only gives the first step.
+        self.adaptive_time_step = self.ps.config.get('adaptiveTimeStep', False)
+        self.cfl_factor = self.ps.config.get('cflFactor', 0.4)
+        self.force_factor = self.ps.config.get('forceFactor', 0.25)
+        self.dt_min = self.ps.config.get('dtMin', 1e-5)
+        self.dt_max = self.ps.config.get('dtMax', 2e-3)
+        self.sound_speed = 0.0  # set by solvers with a stiff equation of state
+        self.max_velocity = ti.field(ti.f32, shape=())
+        self.max_acceleration = ti.field(ti.f32, shape=())
+
+        # Merge the pointwise stages of a substep into fewer kernels, see WCSPHSolver.substep.
+        self.fused_substep = self.ps.config.get('fusedSubstep', False)
+        # Compile the steps of step_batch into one kernel, see run_steps. Deletion and the neighbor list decide on the
+        # host whether to run, so they keep the launches of step. The profiler switches it off while attached.
+        self.use_batched_steps = self.ps.config.get('batchedSteps', True) and \
+            not self.ps.use_particle_deletion and not self.ps.use_neighbor_list
+        # Most of the gain comes from one launch per step. Unrolling more steps hardly runs faster on the CPU, but
+        # roughly triples the compile time with every doubling.
+        self.max_batched_steps = self.ps.config.get('maxBatchedSteps', 1)
+
+        self.use_density_map = len(self.ps.density_map_bodies) > 0
+        self.density_map = density_map.DensityMap(self, self.ps.density_map_bodies) if self.use_density_map else None
+
     @ti.func
     def cubic_spline_kernel(self, r_norm):
+        kernel_val = 0.0
+        if ti.static(self.use_kernel_table):
+            kernel_val = self.lookup_kernel_table(self.kernel_table, r_norm)
+        else:
+            kernel_val = self.analytic_cubic_spline_kernel(r_norm)
+        return kernel_val
+
+    @ti.func
+    def cubic_spline_kernel_derivative(self, r):
+        r_norm = r.norm()
+        r_hat = ti.select(r_norm > 1e-7, r / r_norm, r / (r_norm + 1e-7))
+        derivative_val = 0.0
+        if ti.static(self.use_kernel_table):
+            derivative_val = self.lookup_kernel_table(self.kernel_derivative_table, r_norm)
+        else:
+            derivative_val = self.analytic_cubic_spline_kernel_derivative(r_norm)
+        return derivative_val * r_hat
+
+    @ti.func
+    def lookup_kernel_table(self, table: ti.template(), r_norm):
+        x = r_norm / self.ps.support_length * self.kernel_table_size
+        k = ti.cast(x, ti.i32)
+        val = 0.0
+        if k < self.kernel_table_size:
+            val = table[k] + (x - k) * (table[k + 1] - table[k])
+        return val
+
+    @ti.kernel
+    def build_kernel_table(self):
+        for k in range(self.kernel_table_size + 1):
+            r_norm = k / self.kernel_table_size * self.ps.support_length
+            self.kernel_table[k] = self.analytic_cubic_spline_kernel(r_norm)
+            self.kernel_derivative_table[k] = self.analytic_cubic_spline_kernel_derivative(r_norm)
+
+    @ti.kernel
+    def measure_kernel_table_error(self, sample_num: int, error: ti.types.ndarray()):
+        # error[0]: max |W_table - W|, error[1]: max |dW_table - dW|
+        for k in range(sample_num):
+            r_norm = (k + 0.5) / sample_num * self.ps.support_length
+            ti.atomic_max(error[0], ti.abs(self.lookup_kernel_table(self.kernel_table, r_norm) -
+                                           self.analytic_cubic_spline_kernel(r_norm)))
+            ti.atomic_max(error[1], ti.abs(self.lookup_kernel_table(self.kernel_derivative_table, r_norm) -
+                                           self.analytic_cubic_spline_kernel_derivative(r_norm)))
+
+    @ti.kernel
+    def sum_kernel_samples(self, sample_num: int, use_table: int) -> ti.f32:
+        acc = 0.0
+        for k in range(sample_num):
+            r_norm = (k % 1024 + 0.5) / 1024 * self.ps.support_length
+            if use_table:
+                acc += self.lookup_kernel_table(self.kernel_table, r_norm) + \
+                       self.lookup_kernel_table(self.kernel_derivative_table, r_norm)
+            else:
+                acc += self.analytic_cubic_spline_kernel(r_norm) + \
+                       self.analytic_cubic_spline_kernel_derivative(r_norm)
+        return acc
+
+    def check_kernel_table(self, sample_num=1000000):
+        """
+        Compare the tabulated kernel against the analytic one. Errors are relative to the largest value of W and
+        |dW/dr| over the support, times are for sample_num evaluations of W and dW/dr.
+        """
+        error = np.zeros(2, dtype=np.float32)
+        self.measure_kernel_table_error(sample_num, error)
+        h = self.ps.support_length
+        coeff = 8 / np.pi if self.ps.dim == 3 else 40 / 7 / np.pi
+        kernel_max = coeff / h ** self.ps.dim
+        derivative_max = 2 * coeff / h ** (self.ps.dim + 1)  # |dW/dr| peaks at q = 1/3
+        report = {'table_size': self.kernel_table_size,
+                  'kernel_relative_error': float(error[0] / kernel_max),
+                  'derivative_relative_error': float(error[1] / derivative_max)}
+        for name, use_table in [('analytic_time', 0), ('table_time', 1)]:
+            self.sum_kernel_samples(sample_num, use_table)  # compile
+            start = time.perf_counter()
+            self.sum_kernel_samples(sample_num, use_table)
+            ti.sync()
+            report[name] = time.perf_counter() - start
+        return report
+
+    @ti.func
+    def analytic_cubic_spline_kernel(self, r_norm):
         """
         Smoothed Particle Hydrodynamics     eq (3.31)
         https://arxiv.org/abs/1007.1245v2
@@ -35,27 +152,26 @@ class SPHBase:
         return kernel_val
 
     @ti.func
-    def cubic_spline_kernel_derivative(self, r):
+    def analytic_cubic_spline_kernel_derivative(self, r_norm):
         """
         Smoothed Particle Hydrodynamics     eq (3.33)
         https://arxiv.org/abs/1007.1245v2
+        dW/dr, the gradient is this times r_hat.
         """
         h = self.ps.support_length
         coeff = 16 / np.pi if self.ps.dim == 3 else 80 / 7 / np.pi
         coeff /= (h ** (self.ps.dim + 1))
-        derivative = ti.Vector([0.0 for _ in range(self.ps.dim)])
-        r_norm = r.norm()
+        derivative = 0.0
         q = r_norm / h
-        r_hat = ti.select(r_norm > 1e-7, r / r_norm, r / (r_norm + 1e-7))
         if q <= 1.0:  # TODO: if q <= 1.0 and r_norm > 1e-7: -> taichi lang error. But can't figure out why it is error.
             if q <= 0.5:
-                derivative = coeff * (9 * q ** 2 - 6 * q) * r_hat
+                derivative = coeff * (9 * q ** 2 - 6 * q)
             else:
-                derivative = coeff * (-3 * (1 - q) ** 2) * r_hat
+                derivative = coeff * (-3 * (1 - q) ** 2)
         return derivative
 
     @ti.func
-    def compute_boundary_volume_task(self, p_i, p_j, delta_bi):
+    def compute_boundary_volume_task(self, p_i, p_j, delta_bi: ti.template()):
         if self.ps.material[p_j] == self.ps.material_rigid:
             delta_bi += self.cubic_spline_kernel((self.ps.position[p_i] - self.ps.position[p_j]).norm())
 
@@ -70,10 +186,10 @@ class SPHBase:
         Density Contrast SPH Interfaces
         https://people.inf.ethz.ch/~sobarbar/papers/Sol08b/Sol08b.pdf
         """
-        for i in range(self.ps.total_particle_num):
+        for i in range(self.ps.dynamic_particle_num, self.ps.total_particle_num):
             if self.ps.is_static_rigid_body(i):
                 delta_bi = self.cubic_spline_kernel(0.0)
-                self.ps.for_all_neighbors(i, self.compute_boundary_volume_task, delta_bi)
+                self.ps.for_all_neighbors_in_grid(i, self.compute_boundary_volume_task, delta_bi)
                 self.ps.volume[i] = 1.0 / delta_bi  # TODO: check 1.0 / delta_bi * 3.0
                 """
                 I think the extra 3.0 factor is due to handle single layer of boundary particles?
@@ -86,35 +202,125 @@ class SPHBase:
                 -> Versatile Rigid-Fluid Coupling for Incompressible SPH [page 3]
                 """
 
+    @ti.func
+    def reduce_max_velocity_and_acceleration(self):
+        self.max_velocity[None] = 0.0
+        self.max_acceleration[None] = 0.0
+        for i in range(self.ps.active_particle_num[None]):
+            if self.ps.is_dynamic[i]:
+                ti.atomic_max(self.max_velocity[None], self.ps.velocity[i].norm())
+                ti.atomic_max(self.max_acceleration[None], self.ps.acceleration[i].norm())
+
+    @ti.func
+    def stable_time_step_bound(self):
+        # Upper bound on top of dtMax for conditions the CFL and force criteria miss, see WCSPHSolver
+        return self.dt_max
+
+    @ti.func
+    def update_time_step(self):
+        """
+        Weakly compressible SPH for free surface flows, Becker and Teschner 2007, (13)
+        CFL condition on the speed of sound plus the fastest particle, and the force condition on the largest
+        acceleration, with the particle diameter as length scale. Clamped to [dtMin, stable_time_step_bound].
+        """
+        self.reduce_max_velocity_and_acceleration()
+        dt = ti.min(self.dt_max, self.stable_time_step_bound())
+        signal_speed = self.sound_speed + self.max_velocity[None]
+        if signal_speed > 0.0:
+            dt = ti.min(dt, self.cfl_factor * self.ps.particle_diameter / signal_speed)
+        if self.max_acceleration[None] > 0.0:
+            dt = ti.min(dt, self.force_factor * ti.sqrt(self.ps.particle_diameter / self.max_acceleration[None]))
+        self.dt[None] = ti.max(dt, self.dt_min)
+
+    @ti.kernel
+    def compute_time_step(self):
+        self.update_time_step()
+
     @ti.func
     def simulate_collision(self, idx, vec):
         self.ps.velocity[idx] -= (1.0 + self.collision_factor) * self.ps.velocity[idx].dot(vec) * vec
 
+    @ti.func
+    def enforce_boundary(self, i):
+        pos = self.ps.position[i]
+        collision_vec = ti.Vector.zero(ti.f32, self.ps.dim)
+        for dim in ti.static(range(self.ps.dim)):
+            if pos[dim] > self.ps.domain_end[dim] - self.ps.padding:
+                collision_vec[dim] += 1.0
+                self.ps.position[i][dim] = self.ps.domain_end[dim] - self.ps.padding
+            elif pos[dim] < self.ps.padding:
+                collision_vec[dim] -= 1.0
+                self.ps.position[i][dim] = self.ps.padding
+        collision_vec_normal = collision_vec.norm()
+        if collision_vec_normal > 1e-6:
+            self.simulate_collision(i, collision_vec / collision_vec_normal)
+
     @ti.kernel
     def enforce_boundary_3D(self):
-        for i in range(self.ps.total_particle_num):
+        self.enforce_boundary_3D_stage()
+
+    @ti.func
+    def enforce_boundary_3D_stage(self):
+        for i in range(self.ps.active_particle_num[None]):
             if self.ps.is_dynamic[i]:
-                pos = self.ps.position[i]
-                collision_vec = ti.Vector.zero(ti.f32, self.ps.dim)
-                for dim in ti.static(range(self.ps.dim)):
-                    if pos[dim] > self.ps.domain_end[dim] - self.ps.padding:
-                        collision_vec[dim] += 1.0
-                        self.ps.position[i][dim] = self.ps.domain_end[dim] - self.ps.padding
-                    elif pos[dim] < self.ps.padding:
-                        collision_vec[dim] -= 1.0
-                        self.ps.position[i][dim] = self.ps.padding
-                collision_vec_normal = collision_vec.norm()
-                if collision_vec_normal > 1e-6:
-                    self.simulate_collision(i, collision_vec / collision_vec_normal)
+                self.enforce_boundary(i)
 
     def initialize(self):
+        if self.use_density_map:
+            self.density_map.build()
+        self.ps.build_static_grid()
         self.ps.update_particle_system()
         self.compute_volume_of_boundary_particle()
 
+    def substep_pipeline(self):
+        """
+        (kernel, stage) pairs of one substep in launch order. Every kernel only calls its stage func, so run_steps can
+        put the stages of several steps into a single kernel.
+        """
+        return []
+
+    def substep_launches(self):
+        """
+        Kernels of one substep in launch order, for substep, the profiler and the benchmark.
+        """
+        return [launch for launch, _ in self.substep_pipeline()]
+
     def substep(self):
-        pass
+        for launch in self.substep_launches():
+            launch()
 
     def step(self):
         self.ps.update_particle_system()
         self.substep()
-        self.enforce_boundary_3D()
+        if not self.fused_substep:
+            # The fused pipeline enforces the boundary inside its advection kernel.
+            self.enforce_boundary_3D()
+
+    @ti.kernel
+    def run_steps(self, step_num: ti.template()):
+        """
+        step_num steps of step in one launch. The steps are unrolled at compile time, the top-level loops of the
+        stages stay parallel and run in order.
+        """
+        for _ in ti.static(range(step_num)):
+            self.ps.sort_dynamic_particles_stage()
+            for _, stage in ti.static(self.substep_pipeline()):
+                stage()
+            if ti.static(not self.fused_substep):
+                self.enforce_boundary_3D_stage()
+
+    def step_batch(self, step_num):
+        """
+        Advance step_num steps. With use_batched_steps they run as run_steps launches of power of two sizes up to
+        maxBatchedSteps, so only a few variants are compiled. Otherwise every step is launched stage by stage.
+        """
+        if not self.use_batched_steps:
+            for _ in range(step_num):
+                self.step()
+            return
+        while step_num > 0:
+            batch_num = 1
+            while batch_num * 2 <= min(step_num, self.max_batched_steps):
+                batch_num *= 2
+            self.run_steps(batch_num)
+            step_num -= batch_num
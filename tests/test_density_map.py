@@ -0,0 +1,63 @@
+#tests/test_density_map.py
+import os
+import sys
+import numpy as np
+import pytest
+import taichi as ti
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+import particle_system
+
+ti.init(arch=ti.cpu, log_level=ti.WARN)
+
+PARTICLE_RADIUS = 0.01
+
+
+def floor_scene(tmp_path, boundary_model, refinement):
+    # A fluid cube dropped on a static floor plate, the rigid body is either particles or a density map
+    simulation_config = benchmark.synthetic_scene(0.1, PARTICLE_RADIUS, str(tmp_path / 'floor.obj'),
+                                                  {'densityMapRefinement': refinement})
+    simulation_config['RigidBodies'][0]['boundaryModel'] = boundary_model
+    ps = particle_system.ParticleSystem(simulation_config)
+    ps.memory_allocation_and_initialization_only_position()
+    ps.memory_allocation_and_initialization()
+    solver = ps.build_solver()
+    solver.initialize()
+    return ps, solver
+
+
+def fluid_positions_and_densities(ps):
+    # Both models hold the same fluid particles, ordered by position so they can be compared one to one
+    particle_num = ps.active_particle_num[None]
+    position = ps.position.to_numpy()[:particle_num]
+    density = ps.density.to_numpy()[:particle_num]
+    order = np.lexsort(np.round(position, 4).T)
+    return position[order], density[order]
+
+
+@pytest.mark.parametrize('refinement', [1, 4])
+def test_density_matches_particle_boundary(tmp_path, refinement):
+    ps, solver = floor_scene(tmp_path, 'particles', 1)
+    solver.update_density()
+    position, density = fluid_positions_and_densities(ps)
+    ps, solver = floor_scene(tmp_path, 'densityMap', refinement)
+    solver.update_density()
+    map_position, map_density = fluid_positions_and_densities(ps)
+
+    np.testing.assert_array_equal(position, map_position)
+    np.testing.assert_allclose(map_density, density, rtol=1e-5)
+
+
+def test_fluid_settles_like_on_particle_boundary(tmp_path):
+    steps = 200
+    ps, solver = floor_scene(tmp_path, 'particles', 1)
+    solver.step_batch(steps)
+    position, _ = fluid_positions_and_densities(ps)
+    ps, solver = floor_scene(tmp_path, 'densityMap', 4)
+    solver.step_batch(steps)
+    map_position, _ = fluid_positions_and_densities(ps)
+
+    # Measured: mean height within 5e-5, the lowest particle 4e-4 deeper with the map
+    assert abs(map_position[:, 1].mean() - position[:, 1].mean()) < 0.01 * PARTICLE_RADIUS
+    assert abs(map_position[:, 1].min() - position[:, 1].min()) < 0.1 * PARTICLE_RADIUS
@@ -0,0 +1,75 @@
+#voxel_cache.py
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+
+
+class VoxelCache:
+    """
+    On-disk cache of voxelized rigid bodies. An entry is a directory of .npy files holding the voxel points and the
+    transformed mesh, loaded memory-mapped so a hit costs about as much as opening the files.
+
+    The key hashes the content of the geometry file together with everything ParticleSystem.load_rigid_body applies
+    to it: scale, translation, rotation and the particle diameter used as voxel pitch. Bump VERSION when the
+    voxelization itself changes.
+    """
+    VERSION = 1
+    ARRAYS = ['points', 'vertices', 'faces']
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def file_hash(file_name):
+        sha = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def key(self, rigid_body, particle_diameter):
+        transform = {
+            'version': self.VERSION,
+            'scale': np.asarray(rigid_body['scale'], dtype=np.float64).tolist(),
+            'translation': np.asarray(rigid_body['translation'], dtype=np.float64).tolist(),
+            'rotationAxis': np.asarray(rigid_body['rotationAxis'], dtype=np.float64).tolist(),
+            'rotationAngle': float(rigid_body['rotationAngle']),
+            'particleDiameter': float(particle_diameter),
+        }
+        sha = hashlib.sha256(self.file_hash(rigid_body['geometryFile']).encode())
+        sha.update(json.dumps(transform, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """
+        Memory-mapped arrays of the entry, or None on a miss.
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in self.ARRAYS}
+        except (OSError, ValueError):
+            # Incomplete or corrupted entry, voxelize again and overwrite it
+            return None
+
+    def store(self, key, points, vertices, faces):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write into a scratch directory first so a concurrent reader never sees a partial entry
+        scratch = tempfile.mkdtemp(dir=self.directory)
+        for name, array in zip(self.ARRAYS, [points, vertices, faces]):
+            np.save(os.path.join(scratch, name + '.npy'), np.ascontiguousarray(array))
+        path = self.entry_path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.replace(scratch, path)
+        except OSError:
+            # Another process stored the same entry meanwhile
+            shutil.rmtree(scratch, ignore_errors=True)
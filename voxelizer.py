@@ -0,0 +1,74 @@
+#voxelizer.py
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from trimesh import remesh, grouping
+from trimesh import transformations as tf
+from trimesh.voxel import base, encoding
+
+
+def surface_voxel_indices(vertices, faces, pitch, max_iter=10, edge_factor=2.0):
+    """
+    trimesh.voxel.creation.voxelize_subdivide for a subset of the faces: subdivide until every edge is shorter than
+    pitch / edge_factor and return the grid index of every vertex, without duplicates. Whether an edge is split only
+    depends on its own length, so subdividing the faces in chunks gives the same vertices as subdividing them at once.
+    """
+    subdivided_vertices, _ = remesh.subdivide_to_size(vertices, faces, max_edge=pitch / edge_factor,
+                                                      max_iter=max_iter)
+    hit = np.round(subdivided_vertices / pitch).astype(int)
+    return hit[grouping.unique_rows(hit)[0]]
+
+
+def surface_voxel_indices_task(task):
+    return surface_voxel_indices(*task)
+
+
+def split_faces(vertices, faces, chunk_num):
+    for chunk in np.array_split(faces, chunk_num):
+        if len(chunk) == 0:
+            continue
+        used, local_faces = np.unique(chunk.ravel(), return_inverse=True)
+        yield vertices[used], local_faces.reshape((-1, 3))
+
+
+def can_fork():
+    """
+    Daemonic processes, e.g. the pool workers of run_sweep.py, may not have children. A process that started the
+    Taichi runtime must not fork either, the children would inherit its threads and device state.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods() or multiprocessing.current_process().daemon:
+        return False
+    taichi = sys.modules.get('taichi')
+    return taichi is None or taichi.lang.impl.get_runtime().prog is None
+
+
+def voxelize(mesh, pitch, worker_num=None):
+    """
+    Same points as mesh.voxelized(pitch).fill().points, with the subdivision, which takes nearly all of the time,
+    spread over worker_num processes, or threads where the process cannot fork (see can_fork). Filling the holes
+    stays with trimesh.
+    """
+    worker_num = worker_num or os.cpu_count() or 1
+    vertices = np.asarray(mesh.vertices, dtype=np.float64)
+    faces = np.asarray(mesh.faces, dtype=np.int64)
+    tasks = [(chunk_vertices, chunk_faces, pitch)
+             for chunk_vertices, chunk_faces in split_faces(vertices, faces, 4 * worker_num)]
+    if worker_num > 1 and can_fork():
+        # fork, since spawn would run the main script of the simulation again in every worker
+        with multiprocessing.get_context('fork').Pool(worker_num) as pool:
+            hits = pool.map(surface_voxel_indices_task, tasks)
+    else:
+        with ThreadPoolExecutor(worker_num) as executor:
+            hits = list(executor.map(surface_voxel_indices_task, tasks))
+    # subdivide_to_size keeps every input vertex, also those without a face
+    hits.append(np.round(vertices / pitch).astype(int))
+    hit = np.concatenate(hits)
+    occupied_index = hit[grouping.unique_rows(hit)[0]]
+
+    origin_index = occupied_index.min(axis=0)
+    origin_position = origin_index * pitch
+    voxel_grid = base.VoxelGrid(encoding.SparseBinaryEncoding(occupied_index - origin_index),
+                                transform=tf.scale_and_translate(scale=pitch, translate=origin_position))
+    return voxel_grid.fill().points